@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the input pipeline and the training step options of train.py.
+
+    python benchmark.py decode --data_root ../../datasets_dir/ROD-synROD/
+    python benchmark.py loader --data_root ../../datasets_dir/ROD-synROD/ --workers 1 2 4 8
+    python benchmark.py compile --batch_size 32
+    python benchmark.py channels_last --batch_size 8 32
+    python benchmark.py checkpoint --batch_size 8 16
+    python benchmark.py optimizer
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data_loader import DatasetGeneratorMultimodal, load_split_index, load_resized, INPUT_RESOLUTION
+from net import ResBase, ResClassifier, RelativeRotationClassifier, RESNET_LAYERS
+from utils import make_paths, make_optimizer
+
+
+def splits(data_root):
+    data_root_source, data_root_target, split_source_train, _, split_target = make_paths(data_root)
+    return [('synROD', data_root_source, split_source_train), ('ROD', data_root_target, split_target)]
+
+
+def bench_decode(args):
+    """
+    Throughput of the full-resolution decode versus the reduced-size JPEG decode (load_resized with fast_decode),
+    per dataset, modality and file format, together with the pixel deviation between the two
+    """
+    failed = False
+    for ds_name, root, label in splits(args.data_root):
+        index = load_split_index(root, label, ds_name=ds_name)
+        rng = np.random.RandomState(0)
+        samples = rng.permutation(len(index))[:args.num_images]
+
+        groups = defaultdict(list)
+        for i in samples:
+            path_rgb, path_depth, _ = index[i]
+            for modality, path in (('rgb', path_rgb), ('depth', path_depth)):
+                groups[(modality, os.path.splitext(path)[1].lower())].append(path)
+
+        for (modality, ext), paths in sorted(groups.items()):
+            timings = {}
+            outputs = {}
+            for fast_decode in (False, True):
+                start = time.perf_counter()
+                outputs[fast_decode] = [load_resized(p, fast_decode) for p in paths]
+                timings[fast_decode] = time.perf_counter() - start
+
+            diff = np.concatenate([np.abs(a.astype(np.int16) - b).ravel()
+                                   for a, b in zip(outputs[False], outputs[True])])
+            ok = diff.mean() <= args.tolerance
+            failed |= not ok
+            print("{:6s} {:5s} {:5s} {:5d} images | full {:7.1f} img/s | draft {:7.1f} img/s | x{:.2f} | "
+                  "mean abs diff {:.3f} max {:3d} | {}".format(
+                    ds_name, modality, ext, len(paths), len(paths) / timings[False], len(paths) / timings[True],
+                    timings[False] / timings[True], diff.mean(), diff.max(), 'OK' if ok else 'ABOVE TOLERANCE'))
+    return not failed
+
+
+def bench_loader(args):
+    """
+    Samples per second of the rotation training loaders against num_workers, with and without the I/O threads which
+    overlap the reads of the RGB and depth images of a batch
+    """
+    for ds_name, root, label in splits(args.data_root):
+        domain = 'Source' if ds_name == 'synROD' else 'Target'
+        for num_workers in args.workers:
+            results = []
+            for io_threads in (0, args.io_threads):
+                dataset = DatasetGeneratorMultimodal(root, label, ds_name=ds_name, domain=domain, do_rot=True,
+                                                     do_flip=True, io_threads=io_threads)
+                loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=num_workers,
+                                    drop_last=True)
+                iterator = iter(loader)
+                # The first batch includes the worker startup
+                next(iterator)
+                num_batches = min(args.num_batches, len(loader) - 1)
+                start = time.perf_counter()
+                for _ in range(num_batches):
+                    next(iterator)
+                results.append(num_batches * args.batch_size / (time.perf_counter() - start))
+                del iterator
+            print("{:6s} workers {:2d} | sequential {:7.1f} samples/s | {} I/O threads {:7.1f} samples/s | x{:.2f}"
+                  .format(ds_name, num_workers, results[0], args.io_threads, results[1], results[1] / results[0]))
+    return True
+
+
+def time_step(step, iterations):
+    # One untimed call to warm up the allocator and the kernels
+    step()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        step()
+    return (time.perf_counter() - start) / iterations
+
+
+def model_steps(nets, x_rgb, x_depth, labels):
+    """
+    Training step (forward and backward of both backbones and both heads, without optimizer) and evaluation forward
+    of train.py on a fixed batch
+    :param nets:
+        RGB ResBase, depth ResBase, ResClassifier, RelativeRotationClassifier
+    :return:
+        train_step, eval_step
+    """
+    net_rgb, net_depth, net_f, net_f_rot = nets
+    ce_loss = torch.nn.CrossEntropyLoss()
+
+    def forward():
+        feat_rgb, pooled_rgb = net_rgb(x_rgb)
+        feat_depth, pooled_depth = net_depth(x_depth)
+        return net_f(torch.cat((feat_rgb, feat_depth), 1)), net_f_rot(torch.cat((pooled_rgb, pooled_depth), 1))
+
+    def train_step():
+        for net in nets:
+            net.train()
+        logits, logits_rot = forward()
+        (ce_loss(logits, labels) + ce_loss(logits_rot, labels)).backward()
+
+    def eval_step():
+        for net in nets:
+            net.eval()
+        with torch.no_grad():
+            forward()
+
+    return train_step, eval_step
+
+
+def make_nets(device, checkpoint_layers=()):
+    torch.manual_seed(0)
+    return [ResBase(checkpoint_layers).to(device), ResBase(checkpoint_layers).to(device),
+            ResClassifier(input_dim=1024, class_num=47).to(device),
+            RelativeRotationClassifier(input_dim=1024, class_num=39).to(device)]
+
+
+@contextlib.contextmanager
+def saved_activations(nets):
+    """
+    Count the bytes of the tensors saved for the backward pass by the forward passes run in the context, excluding
+    the parameters of nets and counting every storage once. Yields a dict whose 'bytes' entry is set on exit
+    """
+    params = {p.untyped_storage().data_ptr() for net in nets for p in net.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    result = {}
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        yield result
+    result['bytes'] = sum(storages.values())
+
+
+def bench_compile(args):
+    """
+    Compilation time and steady-state speedup of torch.compile (as train.py --compile) on a training step (forward and
+    backward of both backbones and of both heads) and on an evaluation forward
+    """
+    device = torch.device(args.device)
+    x_rgb, x_depth = torch.randn(2, args.batch_size, 3, INPUT_RESOLUTION, INPUT_RESOLUTION, device=device)
+    labels = torch.zeros(args.batch_size, dtype=torch.long, device=device)
+    results = {}
+    for compiled in (False, True):
+        nets = make_nets(device)
+        if compiled:
+            for net in nets:
+                net.compile(mode=args.compile_mode)
+        train_step, eval_step = model_steps(nets, x_rgb, x_depth, labels)
+        for name, step in (('train', train_step), ('eval', eval_step)):
+            # The first call compiles
+            start = time.perf_counter()
+            step()
+            first = time.perf_counter() - start
+            steady = time_step(step, args.iterations)
+            results[(name, compiled)] = (first - steady, steady)
+
+    for name in ('train', 'eval'):
+        (_, eager), (compile_time, steady) = results[(name, False)], results[(name, True)]
+        break_even = compile_time / (eager - steady) if eager > steady else float('inf')
+        print("{:5s} batch {:3d} | eager {:7.1f} ms | compiled {:7.1f} ms x{:.2f} | compilation {:5.1f} s | "
+              "break-even after {:.0f} steps".format(name, args.batch_size, 1000 * eager, 1000 * steady,
+                                                     eager / steady, compile_time, break_even))
+    return True
+
+
+def bench_channels_last(args):
+    """
+    Training and evaluation steps with the models and the batches in the default (NCHW) layout versus channels-last
+    (NHWC, as train.py --channels_last), with the largest deviation of the evaluation outputs
+    """
+    device = torch.device(args.device)
+    print("oneDNN available: {}".format(torch.backends.mkldnn.is_available()))
+    failed = False
+    for batch_size in args.batch_size:
+        x_rgb, x_depth = torch.randn(2, batch_size, 3, INPUT_RESOLUTION, INPUT_RESOLUTION, device=device)
+        labels = torch.zeros(batch_size, dtype=torch.long, device=device)
+        timings = []
+        outputs = []
+        for memory_format in (torch.contiguous_format, torch.channels_last):
+            nets = [net.to(memory_format=memory_format) for net in make_nets(device)]
+            inputs = [x.contiguous(memory_format=memory_format) for x in (x_rgb, x_depth)]
+            train_step, eval_step = model_steps(nets, *inputs, labels)
+            timings.append((time_step(train_step, args.iterations), time_step(eval_step, args.iterations)))
+            with torch.no_grad():
+                outputs.append(nets[0](inputs[0])[0])
+        diff = (outputs[0] - outputs[1]).abs().max().item()
+        ok = diff <= args.tolerance
+        failed |= not ok
+        (train_nchw, eval_nchw), (train_nhwc, eval_nhwc) = timings
+        print("batch {:3d} | train NCHW {:7.1f} ms NHWC {:7.1f} ms x{:.2f} | eval NCHW {:7.1f} ms NHWC {:7.1f} ms "
+              "x{:.2f} | max abs diff {:.2e} | {}".format(
+                batch_size, 1000 * train_nchw, 1000 * train_nhwc, train_nchw / train_nhwc, 1000 * eval_nchw,
+                1000 * eval_nhwc, eval_nchw / eval_nhwc, diff, 'OK' if ok else 'ABOVE TOLERANCE'))
+    return not failed
+
+
+def bench_checkpoint(args):
+    """
+    Training step time and activation memory of the backbones with activation checkpointing of increasingly many
+    ResNet layers (train.py --checkpoint_layers). The activation memory is the size of the tensors saved for the
+    backward pass, and on CUDA also the peak of the allocated memory during the step
+    """
+    device = torch.device(args.device)
+    configurations = [RESNET_LAYERS[:n] for n in range(len(RESNET_LAYERS) + 1)]
+    for batch_size in args.batch_size:
+        x_rgb, x_depth = torch.randn(2, batch_size, 3, INPUT_RESOLUTION, INPUT_RESOLUTION, device=device)
+        labels = torch.zeros(batch_size, dtype=torch.long, device=device)
+        baseline = None
+        for checkpoint_layers in configurations:
+            nets = make_nets(device, checkpoint_layers)
+            train_step, _ = model_steps(nets, x_rgb, x_depth, labels)
+            step_time = time_step(train_step, args.iterations)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            with saved_activations(nets) as saved:
+                train_step()
+            peak = ""
+            if device.type == 'cuda':
+                peak = " | peak allocated {:7.1f} MB".format(torch.cuda.max_memory_allocated(device) / 2 ** 20)
+            if baseline is None:
+                baseline = step_time, saved['bytes']
+            print("batch {:3d} | {:27s} | step {:7.1f} ms x{:.2f} | saved activations {:7.1f} MB x{:.2f}{}".format(
+                batch_size, ' '.join(checkpoint_layers) or 'no checkpointing', 1000 * step_time,
+                step_time / baseline[0], saved['bytes'] / 2 ** 20, saved['bytes'] / baseline[1], peak))
+    return True
+
+
+def bench_optimizer(args):
+    """
+    zero_grad and step of an SGD per network (as train.py before make_optimizer, with the default kernels) versus a
+    single SGD with a parameter group per network with the multi-tensor (foreach) and the fused kernels
+    """
+    device = torch.device(args.device)
+    nets = make_nets(device)
+    lrs = [args.lr, args.lr, args.lr * 10, args.lr * 10]
+    for net in nets:
+        for p in net.parameters():
+            p.grad = torch.randn_like(p)
+    grads = [p.grad for net in nets for p in net.parameters()]
+    kwargs = dict(momentum=0.9, weight_decay=0.05)
+    configurations = [
+        ('SGD per network', [torch.optim.SGD(net.parameters(), lr=lr, **kwargs) for net, lr in zip(nets, lrs)]),
+        ('single SGD, foreach', [torch.optim.SGD([{'params': net.parameters(), 'lr': lr} for net, lr in zip(nets, lrs)],
+                                                 foreach=True, **kwargs)]),
+        ('single SGD, make_optimizer', [make_optimizer(list(zip(nets, lrs)), **kwargs)]),
+    ]
+    baseline = None
+    for name, optimizers in configurations:
+        def step():
+            for op in optimizers:
+                op.zero_grad(set_to_none=True)
+            # Gradients as left by the backward pass
+            for p, g in zip((p for net in nets for p in net.parameters()), grads):
+                p.grad = g
+            for op in optimizers:
+                op.step()
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        step_time = time_step(step, args.iterations)
+        baseline = baseline or step_time
+        fused = optimizers[0].param_groups[0].get('fused')
+        print("{:27s} | fused {!s:5s} | {:7.2f} ms x{:.2f}".format(name, bool(fused), 1000 * step_time,
+                                                                    baseline / step_time))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the RGB-D training pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    decode_parser = subparsers.add_parser('decode', help="Full versus reduced-size JPEG decoding")
+    decode_parser.add_argument("--data_root", required=True)
+    decode_parser.add_argument("--num_images", default=500, type=int, help="Samples per split")
+    decode_parser.add_argument("--tolerance", default=2.0, type=float,
+                               help="Maximum mean absolute pixel difference (0-255 scale)")
+    decode_parser.set_defaults(func=bench_decode)
+
+    loader_parser = subparsers.add_parser('loader', help="DataLoader throughput with and without I/O threads")
+    loader_parser.add_argument("--data_root", required=True)
+    loader_parser.add_argument("--workers", default=[0, 1, 2, 4], type=int, nargs='+', help="num_workers to try")
+    loader_parser.add_argument("--io_threads", default=4, type=int, help="I/O threads per worker")
+    loader_parser.add_argument("--batch_size", default=32, type=int)
+    loader_parser.add_argument("--num_batches", default=20, type=int, help="Timed batches (after the first one)")
+    loader_parser.set_defaults(func=bench_loader)
+
+    compile_parser = subparsers.add_parser('compile', help="Eager versus torch.compile training and evaluation steps")
+    compile_parser.add_argument("--batch_size", default=32, type=int)
+    compile_parser.add_argument("--iterations", default=5, type=int, help="Timed iterations")
+    compile_parser.add_argument("--device", default='cpu')
+    compile_parser.add_argument("--compile_mode", default='default')
+    compile_parser.set_defaults(func=bench_compile)
+
+    channels_last_parser = subparsers.add_parser('channels_last', help="NCHW versus channels-last training and "
+                                                                       "evaluation steps")
+    channels_last_parser.add_argument("--batch_size", default=[8, 32], type=int, nargs='+', help="Batch sizes to try")
+    channels_last_parser.add_argument("--iterations", default=5, type=int, help="Timed iterations")
+    channels_last_parser.add_argument("--device", default='cpu')
+    channels_last_parser.add_argument("--tolerance", default=1e-4, type=float,
+                                      help="Maximum absolute deviation of the backbone outputs")
+    channels_last_parser.set_defaults(func=bench_channels_last)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help="Step time and activation memory with activation "
+                                                                 "checkpointing of the backbone layers")
+    checkpoint_parser.add_argument("--batch_size", default=[8, 16], type=int, nargs='+', help="Batch sizes to try")
+    checkpoint_parser.add_argument("--iterations", default=3, type=int, help="Timed iterations")
+    checkpoint_parser.add_argument("--device", default='cpu')
+    checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+    optimizer_parser = subparsers.add_parser('optimizer', help="An SGD per network versus a single SGD with "
+                                                               "parameter groups")
+    optimizer_parser.add_argument("--iterations", default=20, type=int, help="Timed iterations")
+    optimizer_parser.add_argument("--lr", default=0.0001, type=float)
+    optimizer_parser.add_argument("--device", default='cpu')
+    optimizer_parser.set_defaults(func=bench_optimizer)
+
+    args = parser.parse_args()
+    sys.exit(0 if args.func(args) else 1)
@@ -1,8 +1,14 @@
+import hashlib
+import io
+import json
 import os
 import random
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Subset
 import torchvision.transforms.functional as TF
 
 import numpy as np
@@ -13,6 +19,8 @@ IMG_EXTENSIONS = [
 ]
 
 INPUT_RESOLUTION = 224
+# Side of the square images fed to MyTransform (before cropping)
+RESIZE_RESOLUTION = 256
 
 """Unused as it is not tensor"""
 def tensor_rot_90(x):
@@ -35,8 +43,12 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
-def load_image(path,do_flip,flip):
+def load_image(path,do_flip,flip,draft_size=None):
     img = Image.open(path)
+    # JPEG only: let the decoder downscale by 1/2, 1/4 or 1/8 while staying at least draft_size on both sides
+    # (other formats, e.g. PNG depth maps, ignore it and are decoded at full resolution)
+    if draft_size is not None:
+        img.draft('RGB', (draft_size, draft_size))
     #img = img.flip(1)
     #img = np.array(list(reversed(img)))
     if do_flip:
@@ -45,8 +57,78 @@ def load_image(path,do_flip,flip):
     return img.convert('RGB')
 
 
-def make_sync_dataset(root, label, ds_name='synROD'):
+def read_file(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def load_resized(path, fast_decode=False):
+    """
+    Load an image and resize it exactly as MyTransform does, without flipping
+    :param path:
+    :param fast_decode:
+        Use the reduced-size JPEG decoding of load_image
+    :return:
+        uint8 array of shape (RESIZE_RESOLUTION, RESIZE_RESOLUTION, 3)
+    """
+    draft_size = RESIZE_RESOLUTION if fast_decode else None
+    img = TF.resize(load_image(path, False, False, draft_size), [RESIZE_RESOLUTION, RESIZE_RESOLUTION])
+    return np.asarray(img, dtype=np.uint8)
+
+
+def packed_paths(label):
+    """
+    Paths of the shard and of its offset index written by pack_dataset.py for a split file
+    :param label:
+    :return:
+    """
+    base = os.path.splitext(label)[0] + '_{0}x{0}'.format(RESIZE_RESOLUTION)
+    return base + '.shard', base + '.idx.npz'
+
+
+def tar_shard_dir(label):
+    """
+    Directory of the tar shards written by make_shards.py for a split file
+    """
+    return os.path.splitext(label)[0] + '_shards'
+
+
+def resized_root(root):
+    """
+    Root of the pre-resized copy of a dataset written by preresize.py
+    """
+    return os.path.normpath(root) + '_{0}x{0}'.format(RESIZE_RESOLUTION)
+
+
+def resized_path(root, path):
+    """
+    Path in the pre-resized tree of an image of the dataset in root. Images are stored as PNG, so they are lossless
+    """
+    relative = os.path.splitext(os.path.relpath(path, root))[0] + '.png'
+    return os.path.join(resized_root(root), relative)
+
+
+def resize_manifest_path(root):
+    return os.path.join(resized_root(root), 'manifest.json')
+
+
+def load_resize_manifest(root):
+    """
+    :return:
+        The manifest of the pre-resized tree of root, mapping the relative path of every source image to its
+        [mtime_ns, size] when it was resized. Empty if there's no pre-resized tree
+    """
+    path = resize_manifest_path(root)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fp:
+        return json.load(fp)['files']
+
+
+def make_sync_dataset(root, label, ds_name='synROD', prefer_resized=True):
     images = []
+    # Images already resized by preresize.py, used in place of the originals
+    resized = load_resize_manifest(root) if prefer_resized else {}
 
     with open(label, 'r') as labeltxt:
         for line in labeltxt:
@@ -70,12 +152,85 @@ def make_sync_dataset(root, label, ds_name='synROD'):
                 path_depth = path_depth.replace('???', 'surfnorm')
             else:
                 raise ValueError('Unknown dataset {}. Known datasets are synROD, ROD'.format(ds_name))
+            if os.path.relpath(path_rgb, root) in resized:
+                path_rgb = resized_path(root, path_rgb)
+            if os.path.relpath(path_depth, root) in resized:
+                path_depth = resized_path(root, path_depth)
             gt = int(data[1])
             item = (path_rgb, path_depth, gt)
             images.append(item)
         return images
 
 
+class SplitIndex(object):
+    """
+    Compact form of the output of make_sync_dataset: all the paths are stored in a single byte buffer with integer
+    offsets, and the labels in an integer array. Numpy arrays have no per-item reference counts, so the pages are
+    shared by forked DataLoader workers instead of being copied on write.
+    """
+
+    def __init__(self, path_data, path_offsets, labels):
+        self.path_data = path_data
+        self.path_offsets = path_offsets
+        self.labels = labels
+
+    @classmethod
+    def from_list(cls, imgs):
+        paths = [p.encode('utf-8') for path_rgb, path_depth, _ in imgs for p in (path_rgb, path_depth)]
+        path_offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in paths], out=path_offsets[1:])
+        path_data = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        labels = np.array([gt for _, _, gt in imgs], dtype=np.int64)
+        return cls(path_data, path_offsets, labels)
+
+    def path(self, i):
+        return self.path_data[self.path_offsets[i]:self.path_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        return self.path(2 * index), self.path(2 * index + 1), int(self.labels[index])
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def load_split_index(root, label, ds_name='synROD', cache_dir=None):
+    """
+    Same as make_sync_dataset, but returning a SplitIndex which is cached on disk. The cache is keyed by the dataset
+    root, the name and the path of the split file, and is rebuilt whenever the split file or the manifest of the
+    pre-resized tree are modified
+    :param root:
+    :param label:
+    :param ds_name:
+    :param cache_dir:
+        Where to store the cache, by default next to the split file
+    :return:
+    """
+    key = hashlib.sha1('\0'.join([os.path.abspath(root), os.path.abspath(label), ds_name]).encode('utf-8'))
+    cache_dir = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(label))
+    cache_path = os.path.join(cache_dir, '.{}.{}.idx.npz'.format(os.path.basename(label), key.hexdigest()[:16]))
+    stat = os.stat(label)
+    manifest = resize_manifest_path(root)
+    manifest_mtime_ns = os.stat(manifest).st_mtime_ns if os.path.exists(manifest) else 0
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if cache['mtime_ns'] == stat.st_mtime_ns and cache['size'] == stat.st_size and \
+                    cache.get('manifest_mtime_ns') == manifest_mtime_ns:
+                return SplitIndex(cache['path_data'], cache['path_offsets'], cache['labels'])
+
+    index = SplitIndex.from_list(make_sync_dataset(root, label, ds_name=ds_name))
+    try:
+        # Write and rename, so that concurrent runs never read a partial cache
+        temp_path = '{}.{}.tmp.npz'.format(cache_path, os.getpid())
+        np.savez(temp_path, path_data=index.path_data, path_offsets=index.path_offsets, labels=index.labels,
+                 mtime_ns=stat.st_mtime_ns, size=stat.st_size, manifest_mtime_ns=manifest_mtime_ns)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # Read-only dataset directory: just don't cache
+        pass
+    return index
+
+
 def get_relative_rotation(rgb_rot, depth_rot):
     rel_rot = rgb_rot - depth_rot
     if rel_rot < 0:
@@ -84,6 +239,20 @@ def get_relative_rotation(rgb_rot, depth_rot):
     return rel_rot
 
 
+def get_transformation_label(rgb_rot, depth_rot, flip_rgb, flip_depth, domain):
+    """
+    Label of the relative transformation task: relative rotation, domain and vertical flips of the two modalities
+    """
+    calculated_label = get_relative_rotation(rgb_rot, depth_rot)
+    if domain=="Target":
+        calculated_label += 5
+    if flip_rgb:
+        calculated_label += 10
+    if flip_depth:
+        calculated_label += 20
+    return calculated_label
+
+
 
 
 
@@ -96,26 +265,137 @@ class MyTransform(object):
         self.angles = [0, 90, 180, 270]
 
     def __call__(self, img, rot=None):
-        img = TF.resize(img, [256, 256])
-        img = TF.crop(img, self.crop[0], self.crop[1], INPUT_RESOLUTION, INPUT_RESOLUTION)
+        img = self.augment(img, rot)
+        img = TF.to_tensor(img)
+        img = TF.normalize(img, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        return img
+
+    def to_uint8(self, img, rot=None):
         """
-        hflip invariant for natural scenes
+        Same as calling the transform, but without normalization (left to net.InputNormalization on the device)
+        :return:
+            uint8 tensor of shape (3, INPUT_RESOLUTION, INPUT_RESOLUTION)
         """
+        return TF.pil_to_tensor(self.augment(img, rot))
+
+    def augment(self, img, rot=None):
+        img = self.resize_image(img)
+        img = TF.crop(img, self.crop[0], self.crop[1], INPUT_RESOLUTION, INPUT_RESOLUTION)
+        # hflip invariant for natural scenes
         if self.flip:
             img = TF.hflip(img)
         if rot is not None:
             img = TF.rotate(img, self.angles[rot])
-        img = TF.to_tensor(img)
-        img = TF.normalize(img, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         return img
 
+    def resize(self, img):
+        """
+        Only resize the image, cropping, flipping, rotation and normalization are left to BatchTransform
+        :param img:
+        :return:
+            uint8 tensor of shape (3, RESIZE_RESOLUTION, RESIZE_RESOLUTION)
+        """
+        return TF.pil_to_tensor(self.resize_image(img))
+
+    @staticmethod
+    def resize_image(img):
+        # Images already resized (multi-view samples, image cache) are left as they are, which is what resizing them
+        # would give
+        if img.size == (RESIZE_RESOLUTION, RESIZE_RESOLUTION):
+            return img
+        return TF.resize(img, [RESIZE_RESOLUTION, RESIZE_RESOLUTION])
+
+    def params(self, rot_rgb=None, rot_depth=None):
+        """
+        Parameters of this transform for BatchTransform: top, left, flip, RGB rotation, depth rotation
+        """
+        return torch.tensor([self.crop[0], self.crop[1], int(self.flip), rot_rgb or 0, rot_depth or 0])
+
+
+class BatchTransform(object):
+    """
+    Tensor counterpart of MyTransform.to_uint8, applied at once to a batch of uint8 images resized by
+    MyTransform.resize. Cropping, horizontal flip and the right-angle rotation are all permutations of the pixels, so
+    they are composed in a single gather. Followed by net.InputNormalization, the output is bit-equivalent to the PIL
+    path.
+    """
+
+    def __init__(self, memory_format=torch.contiguous_format):
+        # Layout of the output, e.g. torch.channels_last for models converted to it
+        self.memory_format = memory_format
+
+    @staticmethod
+    def pixel_index(aug, rot):
+        """
+        Flat index in the RESIZE_RESOLUTION x RESIZE_RESOLUTION image of every output pixel
+        :param aug:
+            (B, 5) tensor of parameters, see MyTransform.params
+        :param rot:
+            (B,) tensor of rotations (multiples of 90 degrees, counter-clockwise like TF.rotate)
+        :return:
+            (B, INPUT_RESOLUTION * INPUT_RESOLUTION) tensor
+        """
+        n = INPUT_RESOLUTION
+        i = torch.arange(n, device=aug.device).view(1, n, 1)
+        j = torch.arange(n, device=aug.device).view(1, 1, n)
+        rot = rot.view(-1, 1, 1)
+        # Coordinates in the (flipped) crop of the pixel that lands in (i, j) after the rotation
+        y = torch.where(rot == 0, i, torch.where(rot == 1, j, torch.where(rot == 2, n - 1 - i, n - 1 - j)))
+        x = torch.where(rot == 0, j, torch.where(rot == 1, n - 1 - i, torch.where(rot == 2, n - 1 - j, i)))
+        x = torch.where(aug[:, 2].view(-1, 1, 1).bool(), n - 1 - x, x)
+        y = y + aug[:, 0].view(-1, 1, 1)
+        x = x + aug[:, 1].view(-1, 1, 1)
+        return (y * RESIZE_RESOLUTION + x).flatten(start_dim=1)
+
+    def __call__(self, img, aug, rot):
+        b, c = img.shape[:2]
+        index = self.pixel_index(aug, rot).unsqueeze(1).expand(b, c, -1)
+        img = img.flatten(start_dim=2).gather(2, index).view(b, c, INPUT_RESOLUTION, INPUT_RESOLUTION)
+        return img.contiguous(memory_format=self.memory_format)
+
+
+class BatchTransformLoader(object):
+    """
+    Wrap a DataLoader over a dataset with batch_aug=True: move every batch to the device and apply BatchTransform,
+    so that it yields the same batches as the DataLoader over the same dataset with batch_aug=False and uint8=True
+    """
+
+    def __init__(self, loader, device, transform=None):
+        self.loader = loader
+        self.device = device
+        self.transform = transform if transform is not None else BatchTransform()
+
+    def __iter__(self):
+        for batch in self.loader:
+            # Boolean flags (whether the views of a multi-view test sample are the same) stay on the host
+            batch = tuple(x if x.dtype == torch.bool else x.to(self.device, non_blocking=True) for x in batch)
+            *batch, aug = batch
+            if len(batch) >= 6:
+                # Multi-view: the plain view is never rotated
+                no_rot = torch.zeros_like(aug[:, 3])
+                batch[0] = self.transform(batch[0], aug, no_rot)
+                batch[1] = self.transform(batch[1], aug, no_rot)
+                batch[3] = self.transform(batch[3], aug, aug[:, 3])
+                batch[4] = self.transform(batch[4], aug, aug[:, 4])
+            else:
+                batch[0] = self.transform(batch[0], aug, aug[:, 3])
+                batch[1] = self.transform(batch[1], aug, aug[:, 4])
+            yield tuple(batch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
 
 class DatasetGeneratorMultimodal(Dataset):
-    def __init__(self, root, label, ds_name='synROD',domain="Source", do_rot=False, do_flip=False, transform=None):
-        imgs = make_sync_dataset(root, label, ds_name=ds_name)
+    def __init__(self, root, label, ds_name='synROD',domain="Source", do_rot=False, do_flip=False, transform=None,
+                 batch_aug=False, multi_view=False, cache=None, fast_decode=False, uint8=False, io_threads=0):
         self.root = root
         self.label = label
-        self.imgs = imgs
+        self.ds_name = ds_name
         self.transform = transform
         self.do_rot = do_rot
         """
@@ -123,24 +403,166 @@ class DatasetGeneratorMultimodal(Dataset):
         """
         self.do_flip = do_flip
         self.domain  = domain
+        # Return uint8 images and the transform parameters, to be applied by BatchTransform
+        self.batch_aug = batch_aug
+        # Return uint8 images, to be normalized by net.InputNormalization
+        self.uint8 = uint8
+        # Return both the plain view and the rotated view of every sample (requires do_rot). With a transform (test
+        # sets) both views use it, and whether they are the same images is returned too
+        self.multi_view = multi_view
+        # Optional image_cache.SharedImageCache of resized images
+        self.cache = cache
+        # Decode JPEG images close to the resize resolution instead of at full resolution (not bit-exact)
+        self.draft_size = RESIZE_RESOLUTION if fast_decode else None
+        # Threads reading the files of each worker, overlapping RGB and depth and the samples of a batch (no read-ahead
+        # across batches, the workers of the DataLoader already prefetch those)
+        self.io_threads = io_threads
+        self.pool = None
+        self.pool_pid = None
+        self.pending = {}
+        # What load_pair reads for each index, and the class of every sample
+        self.imgs = None
+        self.targets = None
+        self.open_split()
+
+    def open_split(self):
+        """
+        Read the index of the samples of the split file into imgs and targets. Subclasses reading the samples from
+        another source override it together with load_pair
+        """
+        self.imgs = load_split_index(self.root, self.label, ds_name=self.ds_name)
+        self.targets = self.imgs.labels
 
-    def __getitem__(self, index):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['pending'] = {}
+        return state
+
+    def read(self, path):
+        """
+        Future with the content of a file, read by the I/O threads of the current process
+        """
+        # Pools don't survive a fork: each worker starts its own, and drops the reads queued by its parent, whose
+        # futures would never complete in this process
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ThreadPoolExecutor(max_workers=self.io_threads)
+            self.pool_pid = os.getpid()
+            self.pending = {}
+        future = self.pending.pop(path, None)
+        if future is not None:
+            return future
+        return self.pool.submit(read_file, path)
+
+    def __getitems__(self, indices):
+        """
+        Called by the DataLoader with the indices of a whole batch: start reading all of its files at once. The reads
+        are parallel within the batch only, the next batches of the worker are read when the DataLoader requests them
+        """
+        if self.io_threads > 0 and self.cache is None:
+            for index in indices:
+                path_rgb, path_depth, _ = self.imgs[index]
+                for path in (path_rgb, path_depth):
+                    if path not in self.pending:
+                        self.pending[path] = self.read(path)
+        return [self[index] for index in indices]
+
+    def apply(self, transform, img, rot=None):
+        if self.uint8:
+            return transform.to_uint8(img, rot)
+        return transform(img, rot)
+
+    def load_cached(self, path, flip):
+        img = self.cache.get(path)
+        if img is None:
+            img = load_resized(path, self.draft_size is not None)
+            self.cache.put(path, img)
+        img = Image.fromarray(img)
+        # Flipping the resized image gives the same pixels as resizing the flipped one
+        if self.do_flip and flip:
+            img = img.transpose(method=Image.FLIP_TOP_BOTTOM)
+        return img
+
+    def load_pair(self, index, flip_rgb, flip_depth):
         path_rgb, path_depth, target = self.imgs[index]
+        if self.cache is not None:
+            return self.load_cached(path_rgb, flip_rgb), self.load_cached(path_depth, flip_depth), target
+        if self.io_threads > 0:
+            # Both files are requested before waiting for the first one
+            data_rgb, data_depth = self.read(path_rgb), self.read(path_depth)
+            path_rgb, path_depth = io.BytesIO(data_rgb.result()), io.BytesIO(data_depth.result())
+        img_rgb = load_image(path_rgb,self.do_flip,flip_rgb,self.draft_size)
+        img_depth = load_image(path_depth,self.do_flip,flip_depth,self.draft_size)
+        return img_rgb, img_depth, target
+
+    def multi_view_item(self, index):
+        """
+        Decode the pair once and build from it both the plain view (recognition or entropy) and the rotated view
+        (relative transformation), sharing the random crop and horizontal flip, or the transform of the dataset if any.
+        In the latter case the sample also tells (before the batch_aug parameters) whether the rotated view is the
+        plain one, i.e. neither modality is rotated or vertically flipped, so that its features can be reused
+        """
+        flip_rgb = self.do_flip and bool(random.getrandbits(1))
+        flip_depth = self.do_flip and bool(random.getrandbits(1))
+        img_rgb, img_depth, target = self.load_pair(index, False, False)
+
+        top = random.randint(0, 256 - INPUT_RESOLUTION)
+        left = random.randint(0, 256 - INPUT_RESOLUTION)
+        flip = bool(random.getrandbits(1))
+        trans_rgb = random.choice([0, 1, 2, 3])
+        trans_depth = random.choice([0, 1, 2, 3])
+        transform = MyTransform([top, left], flip) if self.transform is None else self.transform
+
+        # Each modality is resized once, both views being taken from the resized image (MyTransform doesn't resize it
+        # again): the vertical flip of the rotated view, as done by load_image, gives the same pixels after resizing
+        img_rgb, img_depth = MyTransform.resize_image(img_rgb), MyTransform.resize_image(img_depth)
+        rot_rgb = img_rgb.transpose(method=Image.FLIP_TOP_BOTTOM) if flip_rgb else img_rgb
+        rot_depth = img_depth.transpose(method=Image.FLIP_TOP_BOTTOM) if flip_depth else img_depth
+
+        if self.batch_aug:
+            img_rgb, img_depth = transform.resize(img_rgb), transform.resize(img_depth)
+            rot_rgb, rot_depth = transform.resize(rot_rgb), transform.resize(rot_depth)
+        else:
+            img_rgb, img_depth = self.apply(transform, img_rgb), self.apply(transform, img_depth)
+            rot_rgb = self.apply(transform, rot_rgb, trans_rgb)
+            rot_depth = self.apply(transform, rot_depth, trans_depth)
+
+        calculated_label = get_transformation_label(trans_rgb, trans_depth, flip_rgb, flip_depth, self.domain)
+        sample = (img_rgb, img_depth, target, rot_rgb, rot_depth, calculated_label)
+        if self.transform is not None:
+            sample += (trans_rgb == 0 and trans_depth == 0 and not flip_rgb and not flip_depth,)
+        if self.batch_aug:
+            sample += (transform.params(trans_rgb, trans_depth),)
+        return sample
+
+    def __getitem__(self, index):
+        return self.make_sample(index)
+
+    def make_sample(self, index):
         """
-        implementing labels for flipping
+        Load a pair and build its sample
+        :param index:
+            What load_pair reads: an index in the split, or the content of the sample for TarShardDataset
         """
+        if self.multi_view:
+            return self.multi_view_item(index)
+        # implementing labels for flipping
         flip_rgb = bool(random.getrandbits(1))
         flip_depth = bool(random.getrandbits(1))
 
-        img_rgb = load_image(path_rgb,self.do_flip,flip_rgb)
-        img_depth = load_image(path_depth,self.do_flip,flip_depth)
+        img_rgb, img_depth, target = self.load_pair(index, flip_rgb, flip_depth)
         trans_rgb = None
         trans_depth = None
 
         # If a custom transform is specified apply that transform
         if self.transform is not None:
-            img_rgb = self.transform(img_rgb)
-            img_depth = self.transform(img_depth)
+            if self.batch_aug:
+                img_rgb = self.transform.resize(img_rgb)
+                img_depth = self.transform.resize(img_depth)
+                aug = self.transform.params()
+            else:
+                img_rgb = self.apply(self.transform, img_rgb)
+                img_depth = self.apply(self.transform, img_depth)
         else:  # Otherwise define a random one (random cropping, random horizontal flip)
             top = random.randint(0, 256 - INPUT_RESOLUTION)
             left = random.randint(0, 256 - INPUT_RESOLUTION)
@@ -161,8 +583,13 @@ class DatasetGeneratorMultimodal(Dataset):
             # Apply the same transform to both modalities, rotating them if required
             #img_rgb = img_rgb.flip(1)
             #img_depth = img_depth.flip(1)
-            img_rgb = transform(img_rgb, trans_rgb)
-            img_depth = transform(img_depth, trans_depth)
+            if self.batch_aug:
+                img_rgb = transform.resize(img_rgb)
+                img_depth = transform.resize(img_depth)
+                aug = transform.params(trans_rgb, trans_depth)
+            else:
+                img_rgb = self.apply(transform, img_rgb, trans_rgb)
+                img_depth = self.apply(transform, img_depth, trans_depth)
             """
             if self.do_flip:
                     trans_rgb = img_rgb.flip(1)
@@ -170,19 +597,313 @@ class DatasetGeneratorMultimodal(Dataset):
             """
 
         if self.do_rot and (self.transform is None):
-            calculated_label = get_relative_rotation(trans_rgb, trans_depth)
-            #if self.do_flip:
-            #    if flip_rgb==flip_depth:
-            #        calculated_label += 5
-            if self.domain=="Target":
-                calculated_label += 5
+            calculated_label = get_transformation_label(trans_rgb, trans_depth, flip_rgb, flip_depth, self.domain)
+            sample = (img_rgb, img_depth, target, calculated_label)
+        else:
+            sample = (img_rgb, img_depth, target)
+        if self.batch_aug:
+            sample += (aug,)
+        return sample
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class PackedDatasetMultimodal(DatasetGeneratorMultimodal):
+    """
+    Drop-in replacement for DatasetGeneratorMultimodal reading the pre-resized images from the shard written by
+    pack_dataset.py. The shard is memory-mapped, so all the workers of all the DataLoaders share the same pages of the
+    OS page cache. Resizing before the vertical flip gives the same pixels as flipping before resizing, hence the
+    samples are exactly those of the file-based dataset.
+    """
+    def __init__(self, root, label, ds_name='synROD', **options):
+        # The shard already holds decoded and resized images, so cache, fast_decode and io_threads are ignored
+        options.update(cache=None, fast_decode=False, io_threads=0)
+        self.shard_path, self.index_path = packed_paths(label)
+        # Opened lazily, so that each worker maps the file instead of receiving a pickled copy
+        self.shard = None
+        super(PackedDatasetMultimodal, self).__init__(root, label, ds_name, **options)
+
+    def open_split(self):
+        if not os.path.exists(self.index_path):
+            raise FileNotFoundError('No packed shard for {}. Run pack_dataset.py first'.format(self.label))
+        with np.load(self.index_path) as index:
+            if index['ds_name'] != self.ds_name:
+                raise ValueError('Shard {} was packed for {}, not {}'.format(self.shard_path, index['ds_name'],
+                                                                             self.ds_name))
+            self.offsets = index['offsets']
+            self.targets = index['labels']
+
+    def __getstate__(self):
+        state = super(PackedDatasetMultimodal, self).__getstate__()
+        state['shard'] = None
+        return state
+
+    def plane(self, offset):
+        if self.shard is None:
+            self.shard = np.memmap(self.shard_path, dtype=np.uint8, mode='r')
+        size = RESIZE_RESOLUTION * RESIZE_RESOLUTION * 3
+        return self.shard[offset:offset + size].reshape(RESIZE_RESOLUTION, RESIZE_RESOLUTION, 3)
+
+    def load_pair(self, index, flip_rgb, flip_depth):
+        offset_rgb, offset_depth = self.offsets[index]
+        img_rgb = Image.fromarray(self.plane(offset_rgb))
+        img_depth = Image.fromarray(self.plane(offset_depth))
+        if self.do_flip:
             if flip_rgb:
-                calculated_label += 10
+                img_rgb = img_rgb.transpose(method=Image.FLIP_TOP_BOTTOM)
             if flip_depth:
-                calculated_label += 20
-            
-            return img_rgb, img_depth, target, calculated_label
+                img_depth = img_depth.transpose(method=Image.FLIP_TOP_BOTTOM)
+        return img_rgb, img_depth, int(self.targets[index])
+
+
+def read_tar_samples(path):
+    """
+    Read a tar shard sequentially
+    :param path:
+    :return:
+        Generator of (rgb bytes, depth bytes, label), in the order of the shard
+    """
+    sample = {}
+    key = None
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # Members are named <key>.<field>[.<extension>], and those of a sample are contiguous
+            member_key, field = member.name.split('.')[:2]
+            if member_key != key:
+                if sample:
+                    yield sample['rgb'], sample['depth'], int(sample['cls'])
+                key, sample = member_key, {}
+            sample[field] = tar.extractfile(member).read()
+        if sample:
+            yield sample['rgb'], sample['depth'], int(sample['cls'])
+
+
+class TarShardDataset(DatasetGeneratorMultimodal, IterableDataset):
+    """
+    Streaming version of DatasetGeneratorMultimodal reading the tar shards written by make_shards.py, so that the files
+    are read sequentially instead of one small file at a time. The order is randomized by shuffling the shards at every
+    epoch and then the samples through a shuffle buffer. The shards are split among the DataLoader workers of all the
+    ranks, each reading its own; when there are fewer shards than workers, every worker reads all of them and keeps one
+    sample out of num_workers * world_size instead.
+    Every worker of every rank yields the same number of whole batches per epoch (see samples_per_consumer), so that the
+    ranks run the same number of steps and the DataLoader length is exact. It must be built with the batch size and the
+    number of workers of its DataLoader, and that loader must drop the last partial batch.
+    """
+    def __init__(self, root, label, ds_name='synROD', shuffle_buffer=1000, seed=0, repeat=False, batch_size=1,
+                 num_workers=0, **options):
+        # The reads are sequential, so cache and io_threads are ignored
+        options.update(cache=None, io_threads=0)
+        self.shard_dir = tar_shard_dir(label)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        # Loop over the epochs forever, for utils.make_stream
+        self.repeat = repeat
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.epoch = 0
+        # Taken when the dataset is built, as DistributedSampler does, since the workers may not be in the process group
+        self.rank, self.world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.rank, self.world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        super(TarShardDataset, self).__init__(root, label, ds_name, **options)
+
+    def open_split(self):
+        index_path = os.path.join(self.shard_dir, 'index.json')
+        if not os.path.exists(index_path):
+            raise FileNotFoundError('No tar shards for {}. Run make_shards.py first'.format(self.label))
+        with open(index_path, 'r') as fp:
+            index = json.load(fp)
+        if index['ds_name'] != self.ds_name:
+            raise ValueError('Shards in {} were written for {}, not {}'.format(self.shard_dir, index['ds_name'],
+                                                                              self.ds_name))
+        self.shards = [os.path.join(self.shard_dir, name) for name in index['shards']]
+        self.num_samples = index['num_samples']
+
+    def set_epoch(self, epoch):
+        """
+        Set the epoch of the shard permutation, as DistributedSampler.set_epoch. Must be called before creating the
+        DataLoader iterator, since the workers get a copy of the dataset
+        """
+        self.epoch = epoch
+
+    def consumer(self):
+        """
+        :return:
+            Index of the current DataLoader worker among those of all the ranks, and their number
+        """
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        if num_workers != max(self.num_workers, 1):
+            raise ValueError('TarShardDataset built for {} workers, read by {}'.format(self.num_workers, num_workers))
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def samples_per_consumer(self):
+        """
+        Samples yielded per epoch by every worker of every rank: the whole batches of an even split of the dataset.
+        Shards hold different numbers of samples, so the workers with fewer samples than that wrap around their own
+        ones and the others drop the excess
+        """
+        num_consumers = self.world_size * max(self.num_workers, 1)
+        return self.num_samples // (num_consumers * self.batch_size) * self.batch_size
+
+    def load_pair(self, index, flip_rgb, flip_depth):
+        # The "index" is the sample itself, as read from the shard
+        data_rgb, data_depth, target = index
+        img_rgb = load_image(io.BytesIO(data_rgb), self.do_flip, flip_rgb, self.draft_size)
+        img_depth = load_image(io.BytesIO(data_depth), self.do_flip, flip_depth, self.draft_size)
         return img_rgb, img_depth, target
 
+    def shard_samples(self, epoch):
+        """
+        All the samples of the shards of the current worker, in the order of the shards
+        """
+        consumer, num_consumers = self.consumer()
+        # Same permutation on all the workers of all the ranks
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+        if len(shards) >= num_consumers:
+            for path in shards[consumer::num_consumers]:
+                yield from read_tar_samples(path)
+        else:
+            i = 0
+            for path in shards:
+                for sample in read_tar_samples(path):
+                    if i % num_consumers == consumer:
+                        yield sample
+                    i += 1
+
+    def samples(self, epoch):
+        """
+        Exactly samples_per_consumer samples of the shards of the current worker
+        """
+        count = self.samples_per_consumer()
+        while count > 0:
+            empty = True
+            for sample in self.shard_samples(epoch):
+                yield sample
+                empty = False
+                count -= 1
+                if count == 0:
+                    return
+            if empty:
+                raise RuntimeError('No samples in the shards of worker {} of {}'.format(*self.consumer()))
+
+    def __iter__(self):
+        if self.samples_per_consumer() == 0:
+            raise ValueError('{} has fewer than a batch of {} samples for each of the {} workers of every rank'.format(
+                self.shard_dir, self.batch_size, max(self.num_workers, 1)))
+        consumer, num_consumers = self.consumer()
+        rng = random.Random((self.seed + self.epoch) * num_consumers + consumer)
+        epoch = self.epoch
+        while True:
+            buffer = []
+            for sample in self.samples(epoch):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield self.make_sample(sample)
+            rng.shuffle(buffer)
+            for sample in buffer:
+                yield self.make_sample(sample)
+            if not self.repeat:
+                return
+            epoch += 1
+
+    def __len__(self):
+        # Samples read by each rank
+        return self.samples_per_consumer() * max(self.num_workers, 1)
+
+
+def select_eval_subset(targets, num_samples, seed=0, stratified=False):
+    """
+    Fixed random subset of a dataset for evaluation
+    :param targets:
+        Array with the class of every sample
+    :param num_samples:
+        Size of the subset (0 or more than the dataset for all the samples)
+    :param seed:
+    :param stratified:
+        Keep the class proportions of the whole dataset
+    :return:
+        Sorted array of indices
+    """
+    rng = np.random.RandomState(seed)
+    if num_samples <= 0 or num_samples >= len(targets):
+        return np.arange(len(targets))
+    if not stratified:
+        return np.sort(rng.choice(len(targets), num_samples, replace=False))
+
+    classes, counts = np.unique(targets, return_counts=True)
+    quota = counts * num_samples / len(targets)
+    per_class = np.floor(quota).astype(np.int64)
+    # Largest remainders get the samples left
+    per_class[np.argsort(per_class - quota)[:num_samples - per_class.sum()]] += 1
+    indices = [rng.choice(np.flatnonzero(targets == c), n, replace=False) for c, n in zip(classes, per_class)]
+    return np.sort(np.concatenate(indices))
+
+
+def eval_cache_path(label, cache_dir, num_samples, seed=0, stratified=False, fast_decode=False):
+    """
+    Path in cache_dir of the evaluation cache of a split file. Depends on the split file (path and mtime), on the subset
+    and on the decoding, so the caches of several datasets and runs can share the directory
+    """
+    key = hashlib.sha1('\0'.join(map(str, [os.path.abspath(label), os.stat(label).st_mtime_ns, num_samples, seed,
+                                            stratified, fast_decode, INPUT_RESOLUTION])).encode('utf-8'))
+    return os.path.join(cache_dir, '{}.{}.eval.pt'.format(os.path.basename(label), key.hexdigest()[:16]))
+
+
+def build_eval_cache(dataset, path, indices, num_workers=0):
+    """
+    Run a deterministic dataset (uint8=True, fixed transform) once on a subset and save the result
+    :param dataset:
+        Dataset returning uint8 (img_rgb, img_depth, target)
+    :param path:
+    :param indices:
+    :param num_workers:
+    """
+    loader = DataLoader(Subset(dataset, indices.tolist()), batch_size=64, num_workers=num_workers)
+    images = torch.empty((len(indices), 2, 3, INPUT_RESOLUTION, INPUT_RESOLUTION), dtype=torch.uint8)
+    labels = torch.empty(len(indices), dtype=torch.int64)
+    i = 0
+    for img_rgb, img_depth, target in loader:
+        images[i:i + len(target), 0] = img_rgb
+        images[i:i + len(target), 1] = img_depth
+        labels[i:i + len(target)] = target
+        i += len(target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    torch.save({'images': images, 'labels': labels, 'indices': torch.from_numpy(indices)}, temp_path)
+    os.replace(temp_path, path)
+
+
+class CachedEvalLoader(object):
+    """
+    Batches of uint8 (img_rgb, img_depth, target) from a file written by build_eval_cache. The file is memory-mapped
+    and the batches are slices of it, so there's no decoding and no copy before moving them to the device.
+    Always in the same order, so the results of different epochs are comparable. In distributed training every rank
+    reads a contiguous part of it
+    """
+
+    def __init__(self, path, batch_size):
+        data = torch.load(path, mmap=True)
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        num_samples = len(data['labels'])
+        start, end = rank * num_samples // world_size, (rank + 1) * num_samples // world_size
+        self.images = data['images'][start:end]
+        self.labels = data['labels'][start:end]
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for i in range(0, len(self.labels), self.batch_size):
+            images = self.images[i:i + self.batch_size]
+            yield images[:, 0], images[:, 1], self.labels[i:i + self.batch_size]
+
     def __len__(self):
-        return len(self.imgs)
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
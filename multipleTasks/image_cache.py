@@ -0,0 +1,180 @@
+import atexit
+import hashlib
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from data_loader import RESIZE_RESOLUTION
+
+SLOT_SHAPE = (RESIZE_RESOLUTION, RESIZE_RESOLUTION, 3)
+SLOT_SIZE = int(np.prod(SLOT_SHAPE))
+
+
+def path_key(path):
+    """
+    64 bit key of a path. 0 marks an empty slot, so it is never returned
+    """
+    key = int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+    return key | 1
+
+
+class SharedImageCache(object):
+    """
+    Cache of decoded and resized images (see data_loader.load_resized) living in shared memory, so that it is shared by
+    all the workers of all the DataLoaders. It must be created in the main process, before the DataLoaders start their
+    workers. Eviction follows the CLOCK policy, an approximation of LRU which only needs a reference bit per slot.
+    Images are found through an open-addressing hash table (linear probing) from path keys to slots, so the lock shared
+    by all the processes is only held for a few probes, and the images are copied outside of it: every slot has a
+    version, odd while its image is being written, which tells the readers whether their copy is consistent.
+    """
+
+    def __init__(self, budget_bytes):
+        self.num_slots = max(int(budget_bytes) // SLOT_SIZE, 1)
+        # Power of two with a load factor of at most 1/2, so that probe sequences stay short
+        self.table_size = 1 << (2 * self.num_slots - 1).bit_length()
+        # Layout: hand, hits, misses | keys | versions | table | reference bits | images
+        size = 8 * 3 + 8 * (2 * self.num_slots + self.table_size) + self.num_slots + SLOT_SIZE * self.num_slots
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.lock = mp.Lock()
+        self.owner = True
+        self.attach()
+        self.counters[:] = 0
+        self.keys[:] = 0
+        self.versions[:] = 0
+        self.table[:] = -1
+        self.ref[:] = 0
+        atexit.register(self.close)
+
+    def attach(self):
+        n, t = self.num_slots, self.table_size
+        buf = self.shm.buf
+        self.counters = np.ndarray((3,), dtype=np.int64, buffer=buf, offset=0)
+        # Key of the image in every slot (0 if none), and its version
+        self.keys = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=24)
+        self.versions = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=24 + 8 * n)
+        # Slot of every entry of the hash table, -1 for the empty entries
+        self.table = np.ndarray((t,), dtype=np.int64, buffer=buf, offset=24 + 16 * n)
+        self.ref = np.ndarray((n,), dtype=np.uint8, buffer=buf, offset=24 + 16 * n + 8 * t)
+        self.images = np.ndarray((n,) + SLOT_SHAPE, dtype=np.uint8, buffer=buf, offset=24 + 17 * n + 8 * t)
+
+    def __getstate__(self):
+        # Only needed when workers are spawned instead of forked
+        return {'name': self.shm.name, 'num_slots': self.num_slots, 'table_size': self.table_size, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.num_slots = state['num_slots']
+        self.table_size = state['table_size']
+        self.lock = state['lock']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self.attach()
+
+    def home(self, key):
+        # The lowest bit of the keys is always set
+        return (key >> 1) & (self.table_size - 1)
+
+    def find(self, key):
+        """
+        Probe the hash table for key, with the lock held
+        :return:
+            Position of its entry in the table, or of the empty entry ending the probe sequence
+        """
+        mask = self.table_size - 1
+        entry = self.home(key)
+        while self.table[entry] >= 0 and self.keys[self.table[entry]] != key:
+            entry = (entry + 1) & mask
+        return entry
+
+    def remove(self, entry):
+        """
+        Delete an entry of the hash table, with the lock held, moving back the following entries of the probe sequence
+        whose home precedes it (backward shift deletion), so that there are no tombstones
+        """
+        mask = self.table_size - 1
+        self.table[entry] = -1
+        current = (entry + 1) & mask
+        while self.table[current] >= 0:
+            home = self.home(self.keys[self.table[current]])
+            # Move it if its home is not in the cyclic interval (entry, current]
+            if (current - home) & mask >= (current - entry) & mask:
+                self.table[entry] = self.table[current]
+                self.table[current] = -1
+                entry = current
+            current = (current + 1) & mask
+
+    def get(self, path):
+        """
+        :param path:
+        :return:
+            A copy of the cached image, or None
+        """
+        key = path_key(path)
+        with self.lock:
+            slot = self.table[self.find(key)]
+            if slot < 0:
+                self.counters[2] += 1
+                return None
+            version = self.versions[slot]
+            self.ref[slot] = 1
+            self.counters[1] += 1
+        img = self.images[slot].copy()
+        if self.versions[slot] != version:
+            # Evicted while copying: the copy may mix two images
+            with self.lock:
+                self.counters[1] -= 1
+                self.counters[2] += 1
+            return None
+        return img
+
+    def put(self, path, img):
+        key = path_key(path)
+        with self.lock:
+            if self.table[self.find(key)] >= 0:
+                return
+            # Advance the hand, giving a second chance to the recently used slots and skipping those being written
+            hand = self.counters[0]
+            for _ in range(2 * self.num_slots + 1):
+                if not self.ref[hand] and not self.versions[hand] & 1:
+                    break
+                self.ref[hand] = 0
+                hand = (hand + 1) % self.num_slots
+            else:
+                # All the slots are being written by other processes
+                return
+            self.counters[0] = (hand + 1) % self.num_slots
+            if self.keys[hand]:
+                self.remove(self.find(self.keys[hand]))
+                self.keys[hand] = 0
+            self.versions[hand] += 1
+        self.images[hand] = img
+        with self.lock:
+            self.versions[hand] += 1
+            entry = self.find(key)
+            # Unless another process cached the same image meanwhile
+            if self.table[entry] < 0:
+                self.keys[hand] = key
+                self.table[entry] = hand
+
+    def stats(self, reset=True):
+        """
+        :param reset:
+            Reset the counters after reading them
+        :return:
+            hits, misses
+        """
+        with self.lock:
+            hits, misses = int(self.counters[1]), int(self.counters[2])
+            if reset:
+                self.counters[1:] = 0
+        return hits, misses
+
+    def close(self):
+        if self.shm is None:
+            return
+        # Drop the views before closing the mapping
+        self.counters = self.keys = self.versions = self.table = self.ref = self.images = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
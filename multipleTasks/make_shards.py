@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Write the synROD/ROD splits as tar shards for TarShardDataset.
+
+Every sample of a split file becomes three contiguous members of a shard: <key>.rgb.<ext> and <key>.depth.<ext> with
+the bytes of the original image files, so they decode exactly as the file-based dataset, and <key>.cls with the label.
+The samples are written in a random order, so that each shard mixes all the classes. The shards and an index.json
+listing them go in a directory next to the split file (see data_loader.tar_shard_dir).
+"""
+import argparse
+import io
+import json
+import os
+import random
+import tarfile
+import time
+
+from tqdm import tqdm
+
+from data_loader import make_sync_dataset, read_file, tar_shard_dir
+from utils import make_paths
+
+
+def add_member(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(root, label, ds_name, samples_per_shard=1000, seed=0):
+    """
+    Write the tar shards and the index of a split file
+    :param root:
+        Dataset root, as for DatasetGeneratorMultimodal
+    :param label:
+        Split file
+    :param ds_name:
+        synROD or ROD
+    :param samples_per_shard:
+    :param seed:
+        Seed of the order of the samples
+    :return:
+        Directory of the shards
+    """
+    shard_dir = tar_shard_dir(label)
+    os.makedirs(shard_dir, exist_ok=True)
+    imgs = make_sync_dataset(root, label, ds_name=ds_name)
+    random.Random(seed).shuffle(imgs)
+    mtime = int(time.time())
+
+    shards = []
+    for start in tqdm(range(0, len(imgs), samples_per_shard), desc=os.path.basename(label)):
+        name = 'shard-{:05d}.tar'.format(len(shards))
+        # Write to a temporary file, so an interrupted run never leaves a truncated shard behind
+        temp_path = os.path.join(shard_dir, name + '.tmp')
+        with tarfile.open(temp_path, 'w') as tar:
+            for key, (path_rgb, path_depth, gt) in enumerate(imgs[start:start + samples_per_shard], start):
+                key = '{:08d}'.format(key)
+                add_member(tar, '{}.rgb{}'.format(key, os.path.splitext(path_rgb)[1]), read_file(path_rgb), mtime)
+                add_member(tar, '{}.depth{}'.format(key, os.path.splitext(path_depth)[1]), read_file(path_depth), mtime)
+                add_member(tar, '{}.cls'.format(key), str(gt).encode('ascii'), mtime)
+        os.replace(temp_path, os.path.join(shard_dir, name))
+        shards.append(name)
+
+    # The index is written last: TarShardDataset refuses a directory without it
+    with open(os.path.join(shard_dir, 'index.json.tmp'), 'w') as fp:
+        json.dump({'ds_name': ds_name, 'num_samples': len(imgs), 'shards': shards}, fp)
+    os.replace(os.path.join(shard_dir, 'index.json.tmp'), os.path.join(shard_dir, 'index.json'))
+    return shard_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synROD/ROD as tar shards")
+    parser.add_argument("--data_root", required=True)
+    parser.add_argument("--samples_per_shard", default=1000, type=int)
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the order of the samples")
+    args = parser.parse_args()
+
+    data_root_source, data_root_target, split_source_train, split_source_test, split_target = make_paths(args.data_root)
+
+    for root, label, ds_name in [(data_root_source, split_source_train, 'synROD'),
+                                 (data_root_source, split_source_test, 'synROD'),
+                                 (data_root_target, split_target, 'ROD')]:
+        print("Wrote {}".format(write_shards(root, label, ds_name, args.samples_per_shard, args.seed)))
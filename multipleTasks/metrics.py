@@ -0,0 +1,149 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class MetricAccumulator:
+    """
+    Running sums of metrics (losses, correct predictions, sample counts, confusion counts...) kept where they are
+    computed: tensors are summed on their device without synchronizing with it, numbers on the host. compute reads
+    all of them with a single transfer, so the host waits for the device once per call instead of once per batch (as
+    .item() does). In distributed training compute sums over all the ranks, which must all call it with the same names
+    """
+    def __init__(self, device=None):
+        """
+        :param device:
+            Device of the all-reduce in distributed training, which must be the CUDA device of the process with nccl
+            (gloo reduces on the CPU)
+        """
+        self.device = device
+        self.sums = {}
+
+    def add(self, **values):
+        """
+        Add values to the sums with the same names
+        :param values:
+            Tensors (of any shape, on any single device) or numbers
+        """
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+
+    def compute(self):
+        """
+        :return:
+            Dict of the sums: floats for scalars (tensors or numbers) and numpy arrays for the other tensors
+        """
+        if dist.is_available() and dist.is_initialized():
+            return self.reduce()
+        results = {name: value for name, value in self.sums.items() if not isinstance(value, torch.Tensor)}
+        tensors = {name: value for name, value in self.sums.items() if isinstance(value, torch.Tensor)}
+        if tensors:
+            # float64 represents the counts exactly
+            values = torch.cat([value.double().flatten() for value in tensors.values()]).cpu()
+            for (name, value), flat in zip(tensors.items(), values.split([v.numel() for v in tensors.values()])):
+                results[name] = flat.item() if value.dim() == 0 else flat.reshape(value.shape).numpy()
+        return results
+
+    def reduce(self):
+        """
+        compute for distributed training: the sums, numbers included, are all-reduced as a single tensor. Every rank
+        must have added the same names, with values of the same shapes: the ranks can't check it without another
+        collective, and would hang or mix up the sums. With nothing added no rank reduces
+        """
+        if not self.sums:
+            return {}
+        names = sorted(self.sums)
+        device = 'cpu'
+        if dist.get_backend() == 'nccl':
+            if self.device is None or torch.device(self.device).type != 'cuda':
+                raise ValueError("nccl reduces CUDA tensors: MetricAccumulator needs the CUDA device of the process")
+            device = self.device
+        values = [torch.as_tensor(self.sums[name]).to(device, torch.float64) for name in names]
+        flat = torch.cat([value.flatten() for value in values])
+        dist.all_reduce(flat)
+        flat = flat.cpu()
+        results = {}
+        for name, value, part in zip(names, values, flat.split([v.numel() for v in values])):
+            results[name] = part.item() if value.dim() == 0 else part.reshape(value.shape).numpy()
+        return results
+
+    @staticmethod
+    def mean(results, name, count):
+        """
+        :return:
+            results[name] / results[count], 0 if there is no count (e.g. an evaluation on no batches)
+        """
+        return results.get(name, 0.0) / results[count] if results.get(count) else 0.0
+
+    def reset(self):
+        self.sums = {}
+
+
+def confusion_counts(preds, targets, num_classes):
+    """
+    Confusion counts of a batch, computed on the device of the inputs, to be summed with MetricAccumulator. This is
+    torch.bincount of targets * num_classes + preds with a fixed number of bins, written as an index_add_ because on
+    CUDA bincount reads the largest value back to size its output, waiting for the device
+    :param preds:
+        (B,) predicted classes
+    :param targets:
+        (B,) true classes
+    :return:
+        (num_classes, num_classes) tensor, rows being the true classes and columns the predicted ones
+    """
+    index = targets * num_classes + preds
+    counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=index.device)
+    return counts.index_add_(0, index, torch.ones_like(index)).view(num_classes, num_classes)
+
+
+class ConfusionMatrix:
+    """
+    Metrics derived from summed confusion counts (see confusion_counts), on the host
+    """
+    def __init__(self, num_classes, counts=None):
+        self.num_classes = num_classes
+        self.counts = np.zeros((num_classes, num_classes)) if counts is None else np.asarray(counts)
+
+    def per_class_accuracy(self):
+        """
+        :return:
+            Recall of every class, NaN for the classes without samples
+        """
+        samples = self.counts.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.diag(self.counts) / samples
+
+    def balanced_accuracy(self):
+        """
+        :return:
+            Mean of the per-class accuracies of the classes with samples, 0 if there are none
+        """
+        accuracy = self.per_class_accuracy()
+        return float(np.nanmean(accuracy)) if not np.isnan(accuracy).all() else 0.0
+
+    def top_confusions(self, k=5):
+        """
+        :return:
+            Up to k (true class, predicted class, count) of the most frequent errors
+        """
+        errors = self.counts.copy()
+        np.fill_diagonal(errors, 0)
+        order = np.argsort(errors, axis=None)[::-1][:k]
+        return [(int(i), int(j), int(errors[i, j])) for i, j in zip(*np.unravel_index(order, errors.shape))
+                if errors[i, j] > 0]
+
+    def log(self, writer, tag, epoch):
+        """
+        Write the balanced accuracy (scalar <tag>_balanced) and a table of the per-class accuracies and of the top
+        confusions (text Confusion/<tag>)
+        """
+        writer.add_scalar("{}_balanced".format(tag), self.balanced_accuracy(), epoch)
+        samples = self.counts.sum(axis=1)
+        lines = ["| class | samples | accuracy |", "|---|---|---|"]
+        lines += ["| {} | {:.0f} | {:.3f} |".format(c, samples[c], a)
+                  for c, a in enumerate(self.per_class_accuracy()) if samples[c] > 0]
+        lines += ["", "| true | predicted | count |", "|---|---|---|"]
+        lines += ["| {} | {} | {} |".format(*confusion) for confusion in self.top_confusions()]
+        writer.add_text("Confusion/{}".format(tag.split('/')[-1]), "\n".join(lines), epoch)
@@ -1,13 +1,100 @@
+import contextlib
+
+import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
 
+RESNET_LAYERS = ('layer1', 'layer2', 'layer3', 'layer4')
+
+
+class InputNormalization(nn.Module):
+    """
+    Device-side counterpart of the end of MyTransform: uint8 images are converted to float and normalized with the
+    ImageNet statistics, using the same operations as TF.to_tensor and TF.normalize. Float images are assumed to be
+    already normalized and are returned as they are.
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(InputNormalization, self).__init__()
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def forward(self, x):
+        if x.dtype != torch.uint8:
+            return x
+        x = x.float().div(255)
+        return x.sub_(self.mean).div_(self.std)
+
+
+class SplitBatchNorm(object):
+    """
+    Batch norm mixin which, in training mode, can normalize consecutive chunks of the batch each with its own batch
+    statistics, as if they went through the layer in separate calls (running statistics included). This allows to
+    forward the sub-batches of different domains together, see utils.BatchNormSplitManager.
+    """
+    # Sizes of the chunks along the batch dimension, None to use the statistics of the whole batch
+    split_sizes = None
+
+    def forward(self, x):
+        if self.split_sizes is None or not self.training or len(self.split_sizes) == 1:
+            return super(SplitBatchNorm, self).forward(x)
+        return torch.cat([super(SplitBatchNorm, self).forward(chunk) for chunk in x.split(self.split_sizes)])
+
+
+class SplitBatchNorm1d(SplitBatchNorm, nn.BatchNorm1d):
+    pass
+
+
+class SplitBatchNorm2d(SplitBatchNorm, nn.BatchNorm2d):
+    pass
+
+
+class BatchNormRecompute(object):
+    """
+    Context of the recomputation of a checkpointed segment during the backward pass. The batch norm layers of the
+    segment normalize the same chunks as in the forward pass (split_sizes may have been reset since), and their running
+    statistics, which the forward pass already updated, are restored afterwards
+    """
+    def __init__(self, modules):
+        self.modules = [m for m in modules if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        self.split_sizes = [getattr(m, 'split_sizes', None) for m in self.modules]
+
+    def __enter__(self):
+        self.split_sizes_backward = [getattr(m, 'split_sizes', None) for m in self.modules]
+        self.buffers = [[b.clone() for b in m.buffers()] for m in self.modules]
+        for m, sizes in zip(self.modules, self.split_sizes):
+            if isinstance(m, SplitBatchNorm):
+                m.split_sizes = sizes
+
+    def __exit__(self, *args):
+        with torch.no_grad():
+            for m, buffers, sizes in zip(self.modules, self.buffers, self.split_sizes_backward):
+                for b, saved in zip(m.buffers(), buffers):
+                    b.copy_(saved)
+                if isinstance(m, SplitBatchNorm):
+                    m.split_sizes = sizes
+        return False
+
+
+def checkpoint_segment(function, modules, *inputs):
+    """
+    Run function on inputs keeping only the inputs for the backward pass, where it is run again (activation
+    checkpointing). modules are those run by function, so that batch norm behaves as if it ran only once
+    """
+    return checkpoint(function, *inputs, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), BatchNormRecompute(modules)))
 
 
 class ResBase(nn.Module):
-    def __init__(self):
+    def __init__(self, checkpoint_layers=()):
+        """
+        :param checkpoint_layers:
+            Names of the layers (layer1 to layer4) whose activations are recomputed in the backward pass instead of
+            being stored, trading compute for memory
+        """
         super(ResBase, self).__init__()
         # Initialize pre-trained resnet18
-        model_resnet = models.resnet18(pretrained=True)
+        model_resnet = models.resnet18(pretrained=True, norm_layer=SplitBatchNorm2d)
 
         # "Steal" pretrained layers from the torchvision pretrained Resnet18
         self.conv1 = model_resnet.conv1
@@ -19,17 +106,24 @@ class ResBase(nn.Module):
         self.layer3 = model_resnet.layer3
         self.layer4 = model_resnet.layer4
         self.avgpool = model_resnet.avgpool
+        self.checkpoint_layers = frozenset(checkpoint_layers)
+
+    def run_layer(self, name, x):
+        layer = getattr(self, name)
+        if name in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+            return checkpoint_segment(layer, list(layer.modules()), x)
+        return layer(x)
 
     def forward(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
         x = self.maxpool(x)
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
+        x = self.run_layer('layer1', x)
+        x = self.run_layer('layer2', x)
+        x = self.run_layer('layer3', x)
 
-        x = self.layer4(x)
+        x = self.run_layer('layer4', x)
         # Non-pooled tensor
         x_p = x
         x = self.avgpool(x)
@@ -45,7 +139,7 @@ class ResClassifier(nn.Module):
         super(ResClassifier, self).__init__()
         self.fc1 = nn.Sequential(
             nn.Linear(input_dim, 1000),
-            nn.BatchNorm1d(1000, affine=True),
+            SplitBatchNorm1d(1000, affine=True),
             nn.ReLU(inplace=True),
             nn.Dropout(p=dropout_p)
         )
@@ -67,17 +161,17 @@ class RelativeRotationClassifier(nn.Module):
 
         self.conv_1x1 = nn.Sequential(
             nn.Conv2d(self.input_dim, self.projection_dim, (1, 1), stride=(1, 1)),
-            nn.BatchNorm2d(self.projection_dim),
+            SplitBatchNorm2d(self.projection_dim),
             nn.ReLU(inplace=True)
         )
         self.conv_3x3 = nn.Sequential(
             nn.Conv2d(self.projection_dim, self.projection_dim * 2, (3, 3), stride=(2, 2)),
-            nn.BatchNorm2d(self.projection_dim * 2),
+            SplitBatchNorm2d(self.projection_dim * 2),
             nn.ReLU(inplace=True)
         )
         self.fc1 = nn.Sequential(
             nn.Linear(self.projection_dim * 3 * 3 * 2, self.projection_dim),
-            nn.BatchNorm1d(self.projection_dim, affine=True),
+            SplitBatchNorm1d(self.projection_dim, affine=True),
             nn.ReLU(inplace=True),
             nn.Dropout(p=0.5)
         )
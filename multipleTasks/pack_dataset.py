@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Pack the synROD/ROD splits into memory-mapped shards for PackedDatasetMultimodal.
+
+Each shard is a single contiguous file of uint8 planes: for every sample of the split, the RGB image and then the
+depth image, both already resized to RESIZE_RESOLUTION x RESIZE_RESOLUTION x 3. The offset of each plane and the labels
+are stored in a small .npz index next to the shard.
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from data_loader import make_sync_dataset, load_resized, packed_paths, RESIZE_RESOLUTION
+from utils import make_paths
+
+
+def load_item(item):
+    path_rgb, path_depth, _ = item
+    return load_resized(path_rgb), load_resized(path_depth)
+
+
+def pack_split(root, label, ds_name, workers=4):
+    """
+    Write the shard and the offset index of a split file
+    :param root:
+        Dataset root, as for DatasetGeneratorMultimodal
+    :param label:
+        Split file
+    :param ds_name:
+        synROD or ROD
+    :param workers:
+        Number of decoding processes
+    :return:
+        Path of the shard
+    """
+    shard_path, index_path = packed_paths(label)
+    imgs = make_sync_dataset(root, label, ds_name=ds_name)
+    plane_size = RESIZE_RESOLUTION * RESIZE_RESOLUTION * 3
+
+    # Two planes per sample, one after the other
+    offsets = np.arange(2 * len(imgs), dtype=np.int64).reshape(-1, 2) * plane_size
+    labels = np.array([gt for _, _, gt in imgs], dtype=np.int64)
+
+    # Write to a temporary file, so an interrupted run never leaves a truncated shard behind
+    temp_path = shard_path + '.tmp'
+    shard = np.memmap(temp_path, dtype=np.uint8, mode='w+', shape=(max(2 * len(imgs), 1) * plane_size,))
+    with Pool(workers) as pool:
+        planes = pool.imap(load_item, imgs, chunksize=16)
+        for i, (rgb, depth) in enumerate(tqdm(planes, total=len(imgs), desc=os.path.basename(label))):
+            shard[offsets[i, 0]:offsets[i, 0] + plane_size] = rgb.reshape(-1)
+            shard[offsets[i, 1]:offsets[i, 1] + plane_size] = depth.reshape(-1)
+    shard.flush()
+    del shard
+    os.replace(temp_path, shard_path)
+
+    np.savez(index_path, offsets=offsets, labels=labels, ds_name=ds_name, resolution=RESIZE_RESOLUTION)
+    return shard_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack synROD/ROD into memory-mapped shards")
+    parser.add_argument("--data_root", required=True)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="Number of decoding processes")
+    args = parser.parse_args()
+
+    data_root_source, data_root_target, split_source_train, split_source_test, split_target = make_paths(args.data_root)
+
+    for root, label, ds_name in [(data_root_source, split_source_train, 'synROD'),
+                                 (data_root_source, split_source_test, 'synROD'),
+                                 (data_root_target, split_target, 'ROD')]:
+        print("Packed {}".format(pack_split(root, label, ds_name, workers=args.workers)))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Write a pre-resized copy of the synROD/ROD images listed in the split files.
+
+The images are resized to RESIZE_RESOLUTION x RESIZE_RESOLUTION exactly as MyTransform does and saved as PNG in a
+parallel tree (see data_loader.resized_root), so make_sync_dataset can transparently use them instead of the
+originals. A manifest records the mtime and size of every source image: running the command again only processes
+new or modified images.
+"""
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+from PIL import Image
+from tqdm import tqdm
+
+from data_loader import make_sync_dataset, load_resized, load_resize_manifest, resize_manifest_path, resized_path
+from utils import make_paths
+
+
+def resize_one(job):
+    src, dst = job
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # Write and rename, so that an interrupted run never leaves a truncated image behind
+    temp_path = dst + '.tmp'
+    Image.fromarray(load_resized(src)).save(temp_path, format='PNG')
+    os.replace(temp_path, dst)
+    return src
+
+
+def preresize(root, splits, workers=4):
+    """
+    Resize all the images of some splits of a dataset
+    :param root:
+        Dataset root, as for DatasetGeneratorMultimodal
+    :param splits:
+        List of (split file, ds_name)
+    :param workers:
+        Number of processes
+    :return:
+        Number of resized images, number of skipped images
+    """
+    manifest = load_resize_manifest(root)
+    sources = set()
+    for label, ds_name in splits:
+        for path_rgb, path_depth, _ in make_sync_dataset(root, label, ds_name=ds_name, prefer_resized=False):
+            sources.update((path_rgb, path_depth))
+
+    jobs = []
+    stats = {}
+    for src in sorted(sources):
+        stat = os.stat(src)
+        stats[src] = [stat.st_mtime_ns, stat.st_size]
+        dst = resized_path(root, src)
+        if manifest.get(os.path.relpath(src, root)) != stats[src] or not os.path.exists(dst):
+            jobs.append((src, dst))
+
+    with Pool(workers) as pool:
+        for src in tqdm(pool.imap_unordered(resize_one, jobs, chunksize=16), total=len(jobs),
+                        desc=os.path.basename(root)):
+            manifest[os.path.relpath(src, root)] = stats[src]
+
+    # The manifest is written last: make_sync_dataset only uses the images it lists
+    manifest_path = resize_manifest_path(root)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump({'files': manifest}, fp)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return len(jobs), len(sources) - len(jobs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-resize synROD/ROD into a parallel tree")
+    parser.add_argument("--data_root", required=True)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="Number of processes")
+    args = parser.parse_args()
+
+    data_root_source, data_root_target, split_source_train, split_source_test, split_target = make_paths(args.data_root)
+
+    for root, splits in [(data_root_source, [(split_source_train, 'synROD'), (split_source_test, 'synROD')]),
+                         (data_root_target, [(split_target, 'ROD')])]:
+        done, skipped = preresize(root, splits, workers=args.workers)
+        print("{}: resized {} images, {} already up to date".format(root, done, skipped))
@@ -11,7 +11,7 @@ lr_mult=1.1 # --lr_mult
 weight_decay=0.04 # --weight_decay
 
 
-echo "Careful, default batch size is 96, which needs 12GB of VRAM. Try 64 for 8GB or 32 for 4 GB"
+echo "Careful, default batch size is 96, which needs 12GB of VRAM in fp32. Try 64 for 8GB or 32 for 4 GB, --accum_steps 2 or 3 to keep 96 with smaller micro-batches, or --precision fp16/bf16 to store half-precision activations"
 #printf "Please, insert new batch size: "
 #read batch_size
 
@@ -0,0 +1,83 @@
+"""
+BatchTransform followed by net.InputNormalization must give exactly the images of the PIL path (MyTransform), so
+that the rotation labels of get_relative_rotation stay valid. Run with: python -m pytest test_batch_transform.py
+"""
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from data_loader import DatasetGeneratorMultimodal, MyTransform, BatchTransformLoader, INPUT_RESOLUTION
+from net import InputNormalization
+
+NUM_SAMPLES = 6
+
+TRANSFORMS = {
+    # Recognition: random crop and horizontal flip
+    'train': dict(),
+    # Relative rotation: right-angle rotations and vertical flips too
+    'rotation': dict(do_rot=True, do_flip=True),
+    # Center crop
+    'test': dict(transform=MyTransform([(256 - INPUT_RESOLUTION) // 2] * 2, False)),
+    # Plain and rotated views of the same pair
+    'multi_view': dict(do_rot=True, do_flip=True, multi_view=True),
+    # Center-crop and rotated views of the test sets, see train.evaluate_fused
+    'multi_view_test': dict(do_rot=True, do_flip=True, multi_view=True,
+                            transform=MyTransform([(256 - INPUT_RESOLUTION) // 2] * 2, False)),
+}
+
+
+@pytest.fixture(scope='module')
+def split(tmp_path_factory):
+    """
+    Tiny synROD-like tree: JPEG and PNG images of various sizes (smaller and larger than the resize resolution), the
+    depth maps being single-channel
+    """
+    root = tmp_path_factory.mktemp('synROD')
+    rng = np.random.RandomState(0)
+    lines = []
+    for i in range(NUM_SAMPLES):
+        h, w = rng.randint(100, 400, 2)
+        path = os.path.join('class{}'.format(i % 3), '***', 'image{}.{}'.format(i, 'jpg' if i % 2 else 'png'))
+        for modality, shape in (('rgb', (h, w, 3)), ('depth', (h, w))):
+            image_path = os.path.join(root, path.replace('***', modality))
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            Image.fromarray(rng.randint(0, 256, shape, dtype=np.uint8)).save(image_path)
+        lines.append('{} {}'.format(path, i % 3))
+    label = os.path.join(root, 'split.txt')
+    with open(label, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return str(root), label
+
+
+def collate(samples):
+    return [torch.stack(field) if torch.is_tensor(field[0]) else torch.tensor(field) for field in zip(*samples)]
+
+
+def batch(dataset, seed):
+    samples = []
+    for index in range(len(dataset)):
+        random.seed(seed * NUM_SAMPLES + index)
+        samples.append(dataset[index])
+    return collate(samples)
+
+
+@pytest.mark.parametrize('name', sorted(TRANSFORMS))
+def test_batch_transform_matches_pil(split, name):
+    root, label = split
+    pil = DatasetGeneratorMultimodal(root, label, **TRANSFORMS[name])
+    batched = DatasetGeneratorMultimodal(root, label, batch_aug=True, **TRANSFORMS[name])
+    normalization = InputNormalization()
+    # Several draws, so that all the crops, flips and rotations are likely to be covered
+    for seed in range(4):
+        expected = batch(pil, seed)
+        output = next(iter(BatchTransformLoader([batch(batched, seed)], 'cpu')))
+        assert len(output) == len(expected)
+        for value, reference in zip(output, expected):
+            if reference.dtype == torch.float32:
+                assert value.dtype == torch.uint8
+                value = normalization(value)
+            assert torch.equal(value, reference)
@@ -0,0 +1,61 @@
+"""
+The reduced-size JPEG decoding of load_image (draft mode) must stay close to the full-resolution decode once resized
+and center-cropped to the network input. Run with: python -m pytest test_draft_decode.py
+"""
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from data_loader import load_resized, INPUT_RESOLUTION, RESIZE_RESOLUTION
+
+# Same mean as the default --tolerance of benchmark.py decode, on 0-255 pixel values
+MEAN_TOLERANCE = 2.0
+MAX_TOLERANCE = 16
+
+# (height, width): large enough for the decoder to downscale by 1/2 or more, and smaller than the resize resolution
+SIZES = [(712, 1079), (1064, 785), (567, 844), (650, 543), (2100, 2300), (180, 200)]
+
+
+@pytest.fixture(scope='module')
+def images(tmp_path_factory):
+    """
+    Tiny tree of photo-like JPEGs (smooth content, as the decoder downscales in the frequency domain) and of a PNG
+    depth map, which is decoded at full resolution either way
+    """
+    root = tmp_path_factory.mktemp('draft')
+    rng = np.random.RandomState(0)
+    paths = []
+    for i, (h, w) in enumerate(SIZES):
+        coarse = rng.randint(0, 256, (8, 8, 3), dtype=np.uint8)
+        path = os.path.join(root, 'rgb', 'image{}.jpg'.format(i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.fromarray(coarse).resize((w, h), Image.BICUBIC).save(path, quality=90)
+        paths.append(path)
+    path = os.path.join(root, 'depth', 'image0.png')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(rng.randint(0, 256, SIZES[0], dtype=np.uint8)).save(path)
+    paths.append(path)
+    return paths
+
+
+def center_crop(img):
+    offset = (RESIZE_RESOLUTION - INPUT_RESOLUTION) // 2
+    return img[offset:offset + INPUT_RESOLUTION, offset:offset + INPUT_RESOLUTION].astype(np.int16)
+
+
+def test_draft_decode_within_tolerance(images):
+    for path in images:
+        full = load_resized(path, False)
+        draft = load_resized(path, True)
+        assert draft.shape == full.shape == (RESIZE_RESOLUTION, RESIZE_RESOLUTION, 3)
+        diff = np.abs(center_crop(draft) - center_crop(full))
+        assert diff.mean() <= MEAN_TOLERANCE, path
+        assert diff.max() <= MAX_TOLERANCE, path
+
+
+def test_draft_decode_exact_without_downscaling(images):
+    # PNGs and JPEGs smaller than the resize resolution are not downscaled by the decoder
+    for path in (images[-2], images[-1]):
+        assert np.array_equal(load_resized(path, True), load_resized(path, False))
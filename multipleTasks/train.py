@@ -1,21 +1,26 @@
 #!/usr/bin/env python3
-import numpy as np
-import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
 
-from net import ResBase, ResClassifier, RelativeRotationClassifier, FlippingClassifier
-from data_loader import DatasetGeneratorMultimodal, MyTransform, INPUT_RESOLUTION
+from net import ResBase, ResClassifier, RelativeRotationClassifier, FlippingClassifier, InputNormalization
+from data_loader import DatasetGeneratorMultimodal, PackedDatasetMultimodal, TarShardDataset, MyTransform, \
+    BatchTransform, BatchTransformLoader, CachedEvalLoader, build_eval_cache, eval_cache_path, select_eval_subset, \
+    INPUT_RESOLUTION
 from utils import *
+from image_cache import SharedImageCache
+from metrics import MetricAccumulator, ConfusionMatrix, confusion_counts
 from tqdm import tqdm
 import os
+import sys
 #from torch.optim import *#Adam
 
 #from SSHead import extractor_from_layer3
 
-os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
-
 class_num_classifier=39 # 110+4+5 = 119
+# Object categories of ROD and synROD
+class_num = 47
 
 # Parse arguments
 parser = argparse.ArgumentParser()
@@ -25,6 +30,15 @@ parser.add_argument("--weight_rot", default=1.0, type=float, help="Weight for th
 parser.add_argument('--weight_ent', default=0.1, type=float, help="Weight for the entropy loss")
 args = parser.parse_args()
 
+# Distributed data-parallel training when launched with torchrun: every process trains on its share of the batches,
+# and only rank 0 prints, logs and saves the checkpoints
+rank, world_size, local_rank = init_distributed(args.dist_backend)
+distributed = world_size > 1
+if distributed:
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+        tqdm = functools.partial(tqdm, disable=True)
+
 """implementing parameters for multiple tasks"""
 """
 parser.add_argument('--quadrant', action='store_true')
@@ -70,14 +84,15 @@ print(f"Run: {hp_string}")
 
 # Initialize checkpoint path and Tensorboard logger
 checkpoint_path = os.path.join(args.logdir, hp_string, 'checkpoint.pth')
-writer = SummaryWriter(log_dir=os.path.join(args.logdir, hp_string), flush_secs=5)
+writer = SummaryWriter(log_dir=os.path.join(args.logdir, hp_string), flush_secs=5) if rank == 0 else NullWriter()
 
 # Device. If CUDA is not available (!!!) run on CPU
 if not torch.cuda.is_available():
     print("WARNING! CUDA not available")
     device = torch.device('cpu')
 else:
-    device = torch.device(f'cuda:{args.gpu}')
+    # One GPU per process in distributed training
+    device = torch.device(f'cuda:{local_rank if distributed else args.gpu}')
     # Print device name
     print(f"Running on device {torch.cuda.get_device_name(device)}")
 
@@ -90,95 +105,180 @@ test_transform = MyTransform([int((256 - INPUT_RESOLUTION) / 2), int((256 - INPU
 
 data_root_source, data_root_target, split_source_train, split_source_test, split_target = make_paths(args.data_root)
 
-# Source: training set
-train_set_source = DatasetGeneratorMultimodal(data_root_source, split_source_train,domain="Source", do_rot=False)
+# With gradient accumulation the training loaders yield micro-batches, batch_size being the batch of an optimizer step
+if args.batch_size % args.accum_steps != 0:
+    raise ValueError("batch_size ({}) must be a multiple of accum_steps ({})".format(args.batch_size, args.accum_steps))
+micro_batch_size = args.batch_size // args.accum_steps
+
+# Pre-resized memory-mapped shards (see pack_dataset.py) or the original image files
+Dataset = PackedDatasetMultimodal if args.packed else DatasetGeneratorMultimodal
+# Decoded images shared by the workers of all the loaders. Must exist before any worker is started
+image_cache = SharedImageCache(args.cache_mb << 20) if args.cache_mb > 0 else None
+Dataset = functools.partial(Dataset, batch_aug=args.batch_aug, cache=image_cache, fast_decode=args.fast_decode,
+                            uint8=args.uint8, io_threads=args.io_threads)
+# The training sets can be streamed from the tar shards written by make_shards.py, which shuffle by themselves
+TrainDataset = Dataset
+if args.tar_shards:
+    TrainDataset = functools.partial(TarShardDataset, batch_aug=args.batch_aug, fast_decode=args.fast_decode,
+                                     uint8=args.uint8, shuffle_buffer=args.shuffle_buffer,
+                                     batch_size=micro_batch_size, num_workers=args.num_workers)
+shuffle_train = not args.tar_shards
+
+# Source: training set (also for relative rotation in multi-view mode)
+train_set_source = TrainDataset(data_root_source, split_source_train,domain="Source", do_rot=args.multi_view,
+                                do_flip=args.multi_view, multi_view=args.multi_view)
 # Source: test set
-test_set_source = DatasetGeneratorMultimodal(data_root_source, split_source_test,domain="Source", do_rot=False,
-                                             transform=test_transform)
-# Target: training set (for entropy)
-train_set_target = DatasetGeneratorMultimodal(data_root_target, split_target,domain="Target", ds_name='ROD',
-                                              do_rot=False)
+test_set_source = Dataset(data_root_source, split_source_test,domain="Source", do_rot=False,
+                          transform=test_transform)
+# Target: training set (for entropy, and relative rotation in multi-view mode)
+# The auxiliary training sets are sampled with replacement by IteratorWrapper, so the streamed ones never end
+aux_args = {'repeat': True} if args.tar_shards else {}
+train_set_target = TrainDataset(data_root_target, split_target,domain="Target", ds_name='ROD',
+                                do_rot=args.multi_view, do_flip=args.multi_view, multi_view=args.multi_view, **aux_args)
 # Target: test set
-test_set_target = DatasetGeneratorMultimodal(data_root_target, split_target,domain="Target", ds_name='ROD', do_rot=False,
-                                             transform=test_transform)
+test_set_target = Dataset(data_root_target, split_target,domain="Target", ds_name='ROD', do_rot=False,
+                          transform=test_transform)
 # Source: training set (for relative rotation)
-trans_set_source = DatasetGeneratorMultimodal(data_root_source, split_source_train,domain="Source", do_rot=True, do_flip=True)
+trans_set_source = TrainDataset(data_root_source, split_source_train,domain="Source", do_rot=True, do_flip=True,
+                                **aux_args)
 # Source: test set (for relative rotation)
-trans_test_set_source = DatasetGeneratorMultimodal(data_root_source, split_source_test,domain="Source", do_rot=True, do_flip=True)
-# Target: training and test set (for relative rotation)
-trans_set_target = DatasetGeneratorMultimodal(data_root_target, split_target, ds_name='ROD',domain="Target",
-                                            do_rot=True, do_flip=True)
+trans_test_set_source = Dataset(data_root_source, split_source_test,domain="Source", do_rot=True, do_flip=True)
+# Target: training set (for relative rotation)
+trans_set_target = TrainDataset(data_root_target, split_target, ds_name='ROD',domain="Target",
+                                do_rot=True, do_flip=True, **aux_args)
+# Target: test set (for relative rotation)
+trans_test_set_target = Dataset(data_root_target, split_target, ds_name='ROD',domain="Target",
+                                do_rot=True, do_flip=True)
+if args.fused_eval:
+    if args.eval_cache:
+        raise ValueError("--fused_eval decodes the test sets for both tasks, it can't use --eval_cache")
+    # Test sets with the center-crop view and the rotated view of every sample (see evaluate_fused)
+    fused_test_set_source = Dataset(data_root_source, split_source_test, domain="Source", do_rot=True, do_flip=True,
+                                    transform=test_transform, multi_view=True)
+    fused_test_set_target = Dataset(data_root_target, split_target, ds_name='ROD', domain="Target", do_rot=True,
+                                    do_flip=True, transform=test_transform, multi_view=True)
+tar_sets = [dataset for dataset in (train_set_source, train_set_target, trans_set_source, trans_set_target)
+            if isinstance(dataset, TarShardDataset)]
 
 """
     Prepare data loaders
 """
 
+# Layout of the images and of the convolutional models
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
 # Source training recognition
 train_loader_source = DataLoader(train_set_source,
-                                 shuffle=True,
-                                 batch_size=args.batch_size,
+                                 **sampler_args(train_set_source, shuffle_train),
+                                 batch_size=micro_batch_size,
                                  num_workers=args.num_workers,
                                  drop_last=True)
 
 # Source test recognition
 test_loader_source = DataLoader(test_set_source,
-                                shuffle=True,
+                                **sampler_args(test_set_source, True),
                                 batch_size=args.batch_size,
                                 num_workers=args.num_workers,
                                 drop_last=False)
 
 # Target train
 train_loader_target = DataLoader(train_set_target,
-                                 shuffle=True,
-                                 batch_size=args.batch_size,
+                                 **sampler_args(train_set_target, shuffle_train),
+                                 batch_size=micro_batch_size,
                                  num_workers=args.num_workers,
                                  drop_last=True)
 
 # Target test
 test_loader_target = DataLoader(test_set_target,
-                                shuffle=True,
+                                **sampler_args(test_set_target, True),
                                 batch_size=args.batch_size,
                                 num_workers=args.num_workers,
                                 drop_last=False)
 
-# Source rot
-trans_source_loader = DataLoader(trans_set_source,
-                               shuffle=True,
-                               batch_size=args.batch_size,
-                               num_workers=args.num_workers,
-                               drop_last=True)
+# Source rot. In multi-view mode the rotated views come with the training batches, see MultiViewIterator
+trans_source_loader = None if args.multi_view else DataLoader(trans_set_source,
+                                                              **sampler_args(trans_set_source, shuffle_train),
+                                                              batch_size=micro_batch_size,
+                                                              num_workers=args.num_workers,
+                                                              drop_last=True)
 
 trans_test_source_loader = DataLoader(trans_test_set_source,
-                                    shuffle=True,
+                                    **sampler_args(trans_test_set_source, True),
                                     batch_size=args.batch_size,
                                     num_workers=args.num_workers,
                                     drop_last=False)
 
 # Target rot
 
-trans_target_loader = DataLoader(trans_set_target,
-                               shuffle=True,
-                               batch_size=args.batch_size,
-                               num_workers=args.num_workers,
-                               drop_last=True)
+trans_target_loader = None if args.multi_view else DataLoader(trans_set_target,
+                                                              **sampler_args(trans_set_target, shuffle_train),
+                                                              batch_size=micro_batch_size,
+                                                              num_workers=args.num_workers,
+                                                              drop_last=True)
 
-trans_test_target_loader = DataLoader(trans_set_target,
-                                    shuffle=True,
+trans_test_target_loader = DataLoader(trans_test_set_target,
+                                    **sampler_args(trans_test_set_target, True),
                                     batch_size=args.batch_size,
                                     num_workers=args.num_workers,
                                     drop_last=False)
 
+fused_test_loader_source = fused_test_loader_target = None
+if args.fused_eval:
+    fused_test_loader_source, fused_test_loader_target = (
+        DataLoader(dataset, **sampler_args(dataset, True), batch_size=args.batch_size, num_workers=args.num_workers,
+                   drop_last=False)
+        for dataset in (fused_test_set_source, fused_test_set_target))
+
+if args.prefetch > 0:
+    # The auxiliary loaders never end and never restart their workers
+    train_loader_target = make_stream(train_set_target, micro_batch_size, args.num_workers, args.prefetch)
+    if not args.multi_view:
+        trans_source_loader = make_stream(trans_set_source, micro_batch_size, args.num_workers, args.prefetch)
+        trans_target_loader = make_stream(trans_set_target, micro_batch_size, args.num_workers, args.prefetch)
+
+if args.batch_aug:
+    # The workers only resize, the rest of the augmentation runs on whole batches on the device
+    train_loader_source, test_loader_source, train_loader_target, test_loader_target, trans_source_loader, \
+        trans_test_source_loader, trans_target_loader, trans_test_target_loader, fused_test_loader_source, \
+        fused_test_loader_target = (
+            BatchTransformLoader(loader, device, BatchTransform(memory_format)) if loader is not None else None
+            for loader in (
+                train_loader_source, test_loader_source, train_loader_target, test_loader_target, trans_source_loader,
+                trans_test_source_loader, trans_target_loader, trans_test_target_loader, fused_test_loader_source,
+                fused_test_loader_target))
+
+if args.eval_cache:
+    # Fixed subsets of the test sets (center crop, no flip), decoded once and then memory-mapped
+    num_samples = args.eval_samples if args.eval_samples is not None else args.test_batches * args.batch_size
+    # Written out of the dataset directory, which may be read-only
+    eval_cache_dir = args.eval_cache_dir or os.path.join(args.logdir, 'eval_cache')
+    cache_paths = []
+    for root, split, ds_name, domain in [(data_root_source, split_source_test, 'synROD', 'Source'),
+                                         (data_root_target, split_target, 'ROD', 'Target')]:
+        cache_path = eval_cache_path(split, eval_cache_dir, num_samples, args.eval_seed, args.eval_stratified,
+                                     args.fast_decode)
+        # Built by rank 0 only, the other ranks wait for it at the barrier
+        if rank == 0 and not os.path.exists(cache_path):
+            eval_set = Dataset(root, split, ds_name=ds_name, domain=domain, transform=test_transform, batch_aug=False,
+                               uint8=True)
+            subset = select_eval_subset(eval_set.targets, num_samples, args.eval_seed, args.eval_stratified)
+            build_eval_cache(eval_set, cache_path, subset, args.num_workers)
+        cache_paths.append(cache_path)
+    if distributed:
+        dist.barrier()
+    test_loader_source, test_loader_target = (CachedEvalLoader(path, args.batch_size) for path in cache_paths)
+
 """
     Set up network & optimizer
 """
 # This needs to be changed if a different backbone is used instead of ResNet18
 input_dim_F = 512
 # RGB feature extractor based on ResNet18
-netG_rgb = ResBase()
+netG_rgb = ResBase(args.checkpoint_layers)
 # Depth feature extractor based on ResNet18
-netG_depth = ResBase()
+netG_depth = ResBase(args.checkpoint_layers)
 # Main task: classifier
-netF = ResClassifier(input_dim=input_dim_F * 2, class_num=47, dropout_p=args.dropout_p)
+netF = ResClassifier(input_dim=input_dim_F * 2, class_num=class_num, dropout_p=args.dropout_p)
 netF.apply(weights_init)
 # Pretext task: relative rotation classifier
 netF_rot = RelativeRotationClassifier(input_dim=input_dim_F * 2, class_num=class_num_classifier) #input_dim=input_dim_F * 2, class_num=4
@@ -202,51 +302,305 @@ following weights of the other networks
 # Define a list of the networks. Move everything on the GPU
 net_list = [netG_rgb, netG_depth, netF, netF_rot]
 net_list = map_to_device(device, net_list)
+if args.channels_last:
+    # NHWC weights and activations, the native layout of the oneDNN (CPU) and cuDNN convolutions
+    net_list = tuple(net.to(memory_format=memory_format) for net in net_list)
+# Conversion to float and normalization of the uint8 images (--uint8 and --batch_aug), no-op otherwise
+preprocess = InputNormalization().to(device)
+if args.compile:
+    # Compiled in place, so parameters, state dicts and train()/eval() stay those of the eager modules. The graphs are
+    # guarded on module.training: training and evaluation run separate graphs, each compiled on its first call
+    for net in net_list:
+        net.compile(mode=args.compile_mode)
+if distributed:
+    # The forward passes go through the wrappers, which all-reduce the gradients in the backward passes, while net_list
+    # keeps the modules themselves for train()/eval() and the checkpoints. Batch norm statistics are not broadcast at
+    # every forward pass but averaged before the evaluation (average_buffers)
+    netG_rgb, netG_depth, netF, netF_rot = (
+        DistributedDataParallel(net, device_ids=[device] if device.type == 'cuda' else None, broadcast_buffers=False)
+        for net in net_list)
+
+
+def extract_features(img_rgb, img_depth):
+    """
+    Run both backbones. They run one after the other: fusing them into grouped convolutions (weights stacked once or
+    at every call, or stack_module_state + vmap) was slower than the two passes and not bit-exact
+    :return:
+        Pooled and non-pooled RGB features, pooled and non-pooled depth features
+    """
+    img_rgb = preprocess(img_rgb).contiguous(memory_format=memory_format)
+    img_depth = preprocess(img_depth).contiguous(memory_format=memory_format)
+    feat_rgb, pooled_rgb = netG_rgb(img_rgb)
+    feat_depth, pooled_depth = netG_depth(img_depth)
+    return feat_rgb, pooled_rgb, feat_depth, pooled_depth
+
+
+def pad_batch(*tensors):
+    """
+    With --compile, pad a partial evaluation batch (the last one, as the test loaders don't drop it) to batch_size by
+    repeating its last sample, so that the compiled evaluation graphs always see the same shapes and never recompile
+    :return:
+        Padded tensors and the number of actual samples, to slice the predictions
+    """
+    num_samples = len(tensors[0])
+    if not args.compile or num_samples >= args.batch_size:
+        return tensors, num_samples
+    padding = args.batch_size - num_samples
+    return tuple(torch.cat((t, t[-1:].expand(padding, *t.shape[1:]))) for t in tensors), num_samples
+
 
 # Classification loss
 ce_loss = nn.CrossEntropyLoss()
 
+# Mixed precision: autocast of the forward passes, and loss scaling for fp16 so that small gradients don't underflow
+if args.precision == 'fp16' and device.type != 'cuda':
+    raise ValueError("fp16 needs a CUDA device, use bf16 on CPU")
+amp_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[args.precision]
+scaler = torch.amp.GradScaler(device.type) if args.precision == 'fp16' else None
+
+
+def autocast():
+    return torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+
+def backward(loss):
+    # With gradient accumulation the gradients of the micro-batches are summed, so each loss is averaged over them
+    if args.accum_steps > 1:
+        loss = loss / args.accum_steps
+    # The backward pass runs in the precision chosen by autocast in the forward pass
+    with torch.autocast(device.type, enabled=False):
+        (scaler.scale(loss) if scaler is not None else loss).backward()
+
 # Optimizers
 #Adam
 #optim.SGD
 #RMSprop
-opt_g_rgb = optim.SGD(netG_rgb.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
-opt_g_depth = optim.SGD(netG_depth.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
-opt_f = optim.SGD(netF.parameters(), lr=args.lr*args.lr_mult, momentum=0.9, weight_decay=args.weight_decay)
-opt_f_rot = optim.SGD(netF_rot.parameters(), lr=args.lr * args.lr_mult, momentum=0.9, weight_decay=args.weight_decay)
+# A single SGD with a parameter group per network: backbones at lr, heads at lr * lr_mult. Checkpoints saved with an
+# SGD per network are merged into it by load_checkpoint
+optimizer = make_optimizer([(netG_rgb, args.lr), (netG_depth, args.lr), (netF, args.lr * args.lr_mult),
+                            (netF_rot, args.lr * args.lr_mult)], momentum=0.9, weight_decay=args.weight_decay)
 
 """
 Optimizer for other tasks
 """
-#opt_f_flip = optim.SGD(netF_flip.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+#optimizer.add_param_group({'params': netF_flip.parameters(), 'lr': args.lr})
+
+optims_list = [optimizer]
+
+# Learning rate schedule over the optimizer steps
+steps_per_epoch = len(train_loader_source) // args.accum_steps
+scheduler = make_scheduler(optimizer, args.lr_schedule, args.epochs, steps_per_epoch,
+                           warmup_epochs=args.warmup_epochs, step_epochs=args.lr_step_epochs, gamma=args.lr_gamma)
+schedulers = [scheduler] if scheduler is not None else []
+
+
+
+def joint_step(img_rgb, img_depth, img_label_source):
+    """
+    Training step with a single forward of the backbones on the concatenation of all the sub-batches (source
+    recognition, source rotation, target entropy, target rotation) and a single backward of the total loss. With
+    --bn_mode batch, batch norm normalizes each sub-batch separately, so the gradients are those of the separate passes
+    :return:
+        Dict of the detached losses of the enabled tasks, for logging (see record_train_losses)
+    """
+    # Sub-batches ordered by domain, so that the domain mode only needs two chunks
+    images = [(img_rgb, img_depth)]
+    if args.weight_rot > 0.:
+        img_rgb_rot, img_depth_rot, _, trans_label_source = trans_source_loader_iter.get_next()
+        images.append((img_rgb_rot, img_depth_rot))
+    if args.weight_ent > 0.:
+        images.append(train_target_loader_iter.get_next()[:2])
+    if args.weight_rot > 0.:
+        img_rgb_rot, img_depth_rot, _, trans_label_target = trans_target_loader_iter.get_next()
+        images.append((img_rgb_rot, img_depth_rot))
+    sizes = [len(rgb) for rgb, _ in images]
+    img_rgb = torch.cat([rgb.to(device) for rgb, _ in images])
+    img_depth = torch.cat([depth.to(device) for _, depth in images])
+    num_source = sizes[0] + (sizes[1] if args.weight_rot > 0. else 0)
+
+    if args.bn_mode == 'batch':
+        backbone_sizes = sizes
+    elif args.bn_mode == 'domain':
+        backbone_sizes = [size for size in (num_source, sum(sizes) - num_source) if size > 0]
+    else:
+        backbone_sizes = None
+    with BatchNormSplitManager([netG_rgb, netG_depth], backbone_sizes):
+        feat_rgb, pooled_rgb, feat_depth, pooled_depth = extract_features(img_rgb, img_depth)
+    features = torch.cat((feat_rgb, feat_depth), 1).split(sizes)
+    pooled = torch.cat((pooled_rgb, pooled_depth), 1).split(sizes)
+
+    # Recognition and entropy: first source and first target sub-batch
+    rec_index = [0] + ([len(sizes) - 1 - (args.weight_rot > 0.)] if args.weight_ent > 0. else [])
+    with BatchNormSplitManager([netF], None if args.bn_mode == 'joint' else [sizes[i] for i in rec_index]):
+        logits = netF(torch.cat([features[i] for i in rec_index])).split([sizes[i] for i in rec_index])
+    loss_rec = ce_loss(logits[0], img_label_source.to(device))
+    loss = loss_rec
+    losses = {'loss_rec': loss_rec}
+    if args.weight_ent > 0.:
+        losses['loss_ent'] = entropy_loss(logits[1])
+        loss = loss + args.weight_ent * losses['loss_ent']
+
+    # Relative rotation: second source and second target sub-batch
+    if args.weight_rot > 0.:
+        rot_index = [1, len(sizes) - 1]
+        with BatchNormSplitManager([netF_rot], None if args.bn_mode == 'joint' else [sizes[i] for i in rot_index]):
+            logits_rot = netF_rot(torch.cat([pooled[i] for i in rot_index])).split([sizes[i] for i in rot_index])
+        losses['loss_rot'] = ce_loss(logits_rot[0], trans_label_source.to(device))
+        losses['loss_rot_target'] = ce_loss(logits_rot[1], trans_label_target.to(device))
+        loss = loss + args.weight_rot * (losses['loss_rot'] + losses['loss_rot_target'])
+    backward(loss)
+    return {name: value.detach() for name, value in losses.items()}
+
+
+# Tensorboard tags of the training losses recorded by record_train_losses
+TRAIN_LOSS_TAGS = {'loss_rec': "Loss/train", 'loss_ent': "Loss/ent", 'loss_rot': "Loss/rot",
+                   'loss_rot_target': "Loss/rot_target"}
+
+
+def record_train_losses(epoch, batch_num, losses):
+    """
+    Add the losses of a training micro-batch to the running sums of the epoch, and log the means of the last
+    log_interval optimizer steps, the differences of the sums since the previous log. Only the logging synchronizes
+    with the device, with a single all-reduce of all the losses in distributed training
+    :param losses:
+        Dict of the losses, named as in TRAIN_LOSS_TAGS
+    """
+    train_metrics.add(batches=1, **losses)
+    step = batch_num // args.accum_steps + 1
+    if args.log_interval > 0 and batch_num % args.accum_steps == args.accum_steps - 1 and step % args.log_interval == 0:
+        results = train_metrics.compute()
+        interval = {name: value - logged_sums.get(name, 0.0) for name, value in results.items()}
+        logged_sums.update(results)
+        global_step = (epoch - 1) * steps_per_epoch + step
+        for name in losses:
+            writer.add_scalar(TRAIN_LOSS_TAGS[name] + "_step", MetricAccumulator.mean(interval, name, 'batches'),
+                              global_step)
+
+
+def evaluate_fused(loader, desc, warmup=False):
+    """
+    Evaluate the recognition and the relative rotation task together on a multi-view test loader: the center-crop
+    views and the rotated views of a batch go through the backbones in a single pass, where the rotated views which
+    are the center-crop ones (no rotation nor flip, reported by the dataset) are left out and take their features.
+    The rotated views are taken from the center crop without horizontal flip, unlike those of the separate rotation
+    evaluation (random crop and flip), so the rotation metrics are not comparable with the latter's.
+    Without weight_rot only the center-crop views are evaluated
+    :param warmup:
+        Whether the first batch is a warm-up one for the evaluation timer (compilation)
+    :return:
+        (accuracy, loss, ConfusionMatrix) of the recognition task and of the rotation task
+    """
+    rotation = args.weight_rot > 0.0
+    metrics = MetricAccumulator(device)
+    rot_metrics = MetricAccumulator(device)
+    num_batches = min(len(loader), args.test_batches or len(loader))
+    with EvaluationManager(net_list), autocast(), tqdm(total=num_batches, desc=desc) as pb:
+        for num_batch, (img_rgb, img_depth, label, rot_rgb, rot_depth, rot_label, same_view) in enumerate(loader):
+            if num_batch >= num_batches:
+                break
+            eval_timer.start()
+            img_rgb, img_depth, label = map_to_device(device, (img_rgb, img_depth, label))
+            (img_rgb, img_depth), num_samples = pad_batch(img_rgb, img_depth)
+            num_rows = len(img_rgb)
+            if rotation:
+                if args.compile:
+                    # All the rotated views, padded as well, so that the compiled graphs always see the same shapes
+                    (rot_rgb, rot_depth), _ = pad_batch(rot_rgb, rot_depth)
+                    rot_index = torch.arange(num_rows, 2 * num_rows)
+                else:
+                    # The flags are on the host: choosing the views does not wait for the device
+                    keep = torch.nonzero(~same_view.cpu()).flatten()
+                    rot_rgb, rot_depth = rot_rgb[keep.to(rot_rgb.device)], rot_depth[keep.to(rot_depth.device)]
+                    rot_index = torch.arange(num_samples)
+                    rot_index[keep] = torch.arange(num_rows, num_rows + len(keep))
+                rot_rgb, rot_depth, rot_label = map_to_device(device, (rot_rgb, rot_depth, rot_label))
+                img_rgb, img_depth = torch.cat((img_rgb, rot_rgb)), torch.cat((img_depth, rot_depth))
+
+            feat_rgb, pooled_rgb, feat_depth, pooled_depth = extract_features(img_rgb, img_depth)
+            preds = netF(torch.cat((feat_rgb[:num_rows], feat_depth[:num_rows]), 1))[:num_samples]
+            if rotation:
+                rot_index = rot_index.to(device)
+                preds_rot = netF_rot(torch.cat((pooled_rgb[rot_index], pooled_depth[rot_index]), 1))[:num_samples]
+            eval_timer.stop(warmup=warmup and num_batch == 0)
+
+            pred_labels = torch.argmax(preds, dim=1)
+            metrics.add(loss=ce_loss(preds, label) * num_samples, correct=(pred_labels == label).sum(),
+                        samples=num_samples, confusion=confusion_counts(pred_labels, label, class_num))
+            if rotation:
+                pred_labels = torch.argmax(preds_rot, dim=1)
+                rot_metrics.add(loss=ce_loss(preds_rot, rot_label) * num_samples,
+                                correct=(pred_labels == rot_label).sum(), samples=num_samples,
+                                confusion=confusion_counts(pred_labels, rot_label, class_num_classifier))
+            pb.update(1)
 
-optims_list = [opt_g_rgb, opt_g_depth, opt_f, opt_f_rot]
+    results, rot_results = metrics.compute(), rot_metrics.compute()
+    return ((MetricAccumulator.mean(results, 'correct', 'samples'), MetricAccumulator.mean(results, 'loss', 'samples'),
+             ConfusionMatrix(class_num, results.get('confusion'))),
+            (MetricAccumulator.mean(rot_results, 'correct', 'samples'),
+             MetricAccumulator.mean(rot_results, 'loss', 'samples'),
+             ConfusionMatrix(class_num_classifier, rot_results.get('confusion'))))
 
 
 first_epoch = 1
 if args.resume:
-    first_epoch = load_checkpoint(checkpoint_path, first_epoch, net_list, optims_list)
+    first_epoch = load_checkpoint(checkpoint_path, first_epoch, net_list, optims_list, scaler=scaler,
+                                  scheduler=scheduler)
 
 for epoch in range(first_epoch, args.epochs + 1):
     print("Epoch {} / {}".format(epoch, args.epochs))
+    for dataset in tar_sets:
+        dataset.set_epoch(epoch)
+    # New permutations of the distributed samplers (the auxiliary ones are moved forward by IteratorWrapper)
+    for loader in (train_loader_source, test_loader_source, test_loader_target, trans_test_source_loader,
+                   trans_test_target_loader, fused_test_loader_source, fused_test_loader_target):
+        if isinstance(getattr(loader, 'sampler', None), DistributedSampler):
+            loader.sampler.set_epoch(epoch)
     # ========================= TRAINING =========================
 
-    # Train source (recognition)
-    train_loader_source_rec_iter = train_loader_source
-    # Train target (entropy)
-    train_target_loader_iter = IteratorWrapper(train_loader_target)
-
-    # Source (rotation)
-    trans_source_loader_iter = IteratorWrapper(trans_source_loader)
-    # Target (rotation)
-    trans_target_loader_iter = IteratorWrapper(trans_target_loader)
+    if args.multi_view:
+        # Every training batch carries both views: recognition/entropy and rotation
+        train_loader_source_rec_iter = MultiViewIterator(train_loader_source)
+        train_target_multi_view_iter = MultiViewIterator(train_loader_target, epoch)
+        train_target_loader_iter = train_target_multi_view_iter.stream('plain')
+        trans_source_loader_iter = train_loader_source_rec_iter.stream('rotated')
+        trans_target_loader_iter = train_target_multi_view_iter.stream('rotated')
+    else:
+        # Train source (recognition)
+        train_loader_source_rec_iter = train_loader_source
+        # Train target (entropy)
+        train_target_loader_iter = IteratorWrapper(train_loader_target, epoch)
+
+        # Source (rotation)
+        trans_source_loader_iter = IteratorWrapper(trans_source_loader, epoch)
+        # Target (rotation)
+        trans_target_loader_iter = IteratorWrapper(trans_target_loader, epoch)
 
     # Training loop. The tqdm thing is to show progress bar
-    with tqdm(total=len(train_loader_source), desc="Train  ") as pb:
+    # Step times, the first ones with --compile being warm-up (compilation of the graphs)
+    compile_warmup = args.compile and epoch == first_epoch
+    train_timer = StepTimer(device)
+    eval_timer = StepTimer(device)
+    # Micro-batches of the whole optimizer steps, the remainder is dropped as drop_last does with batches
+    num_micro_batches = steps_per_epoch * args.accum_steps
+    # Training losses summed on the device over the epoch, and their sums at the last log
+    train_metrics = MetricAccumulator(device)
+    logged_sums = {}
+    with tqdm(total=num_micro_batches, desc="Train  ") as pb:
         for batch_num, (img_rgb, img_depth, img_label_source) in enumerate(train_loader_source_rec_iter):
-            # The optimization step is performed by OptimizerManager
-            with OptimizerManager(optims_list):
-
+            if batch_num >= num_micro_batches:
+                break
+            # The optimization step is performed by OptimizerManager, after the last micro-batch. Each micro-batch
+            # draws its own auxiliary batches, so a step sees batch_size samples of every task
+            micro_batch = batch_num % args.accum_steps
+            # In distributed training the gradients are all-reduced in the backward passes of the last micro-batch
+            with train_timer.step(warmup=compile_warmup and batch_num == 0), \
+                    OptimizerManager(optims_list, scaler, zero_grad=micro_batch == 0,
+                                     step=micro_batch == args.accum_steps - 1, schedulers=schedulers), \
+                    no_sync((netG_rgb, netG_depth, netF, netF_rot), micro_batch < args.accum_steps - 1), autocast():
+                if args.joint_step:
+                    record_train_losses(epoch, batch_num, joint_step(img_rgb, img_depth, img_label_source))
+                    pb.update(1)
+                    continue
 
                 # Compute source features
                 img_rgb, img_depth, img_label_source = map_to_device(device, (img_rgb, img_depth, img_label_source))
@@ -258,13 +612,13 @@ for epoch in range(first_epoch, args.epochs + 1):
 
                 Then compute the classidication loss.
                 """
-                feat_rgb, _ = netG_rgb(img_rgb)
-                feat_depth, _ = netG_depth(img_depth)
+                feat_rgb, _, feat_depth, _ = extract_features(img_rgb, img_depth)
                 features_source = torch.cat((feat_rgb, feat_depth), 1)
                 logits = netF(features_source)
 
                 # Classification los
                 loss_rec = ce_loss(logits, img_label_source)
+                losses = {'loss_rec': loss_rec.detach()}
 
                 # Entropy loss
                 if args.weight_ent > 0.:
@@ -277,18 +631,18 @@ for epoch in range(first_epoch, args.epochs + 1):
                     Then you use the logits to compute the entropy loss.
                     """
                     img_rgb, img_depth = map_to_device(device, (img_rgb, img_depth))
-                    feat_rgb, _ = netG_rgb(img_rgb)
-                    feat_depth, _ = netG_depth(img_depth)
+                    feat_rgb, _, feat_depth, _ = extract_features(img_rgb, img_depth)
                     features_target = torch.cat((feat_rgb, feat_depth), 1)
                     logits = netF(features_target)
 
                     loss_ent = entropy_loss(logits)
+                    losses['loss_ent'] = loss_ent.detach()
                 else:
                     loss_ent = 0
 
                 # Backpropagate
                 loss = loss_rec + args.weight_ent * loss_ent  # TODO: compute the total loss before backpropagating
-                loss.backward()
+                backward(loss)
 
                 del img_rgb, img_depth, img_label_source
 
@@ -305,19 +659,17 @@ for epoch in range(first_epoch, args.epochs + 1):
                     img_rgb, img_depth, trans_label = map_to_device(device, (img_rgb, img_depth, trans_label))
 
                     # Compute features (without pooling!)
-                    _, pooled_rgb = netG_rgb(img_rgb)
-                    _, pooled_depth = netG_depth(img_depth)
+                    _, pooled_rgb, _, pooled_depth = extract_features(img_rgb, img_depth)
                     # Prediction
                     logits_rot = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))
 
                     # Classification loss for the rleative rotation task
 
                     loss_rot = ce_loss(logits_rot, trans_label)  # TODO
+                    losses['loss_rot'] = loss_rot.detach()
                     loss = args.weight_rot * loss_rot # TODO: compute the total loss
                     # Backpropagate
-                    loss.backward()
-
-                    loss_rot = loss_rot.item()
+                    backward(loss)
 
                     del img_rgb, img_depth, trans_label, loss
 
@@ -331,181 +683,244 @@ for epoch in range(first_epoch, args.epochs + 1):
                     Same thing, but for target
                     """
                     # Compute features (without pooling!)
-                    _, pooled_rgb = netG_rgb(img_rgb)
-                    _, pooled_depth = netG_depth(img_depth)
+                    _, pooled_rgb, _, pooled_depth = extract_features(img_rgb, img_depth)
                     # Prediction
                     logits_rot = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))
 
                     # Classification loss for the rleative rotation task
-                    loss = args.weight_rot * ce_loss(logits_rot, trans_label)
+                    loss_rot_target = ce_loss(logits_rot, trans_label)
+                    losses['loss_rot_target'] = loss_rot_target.detach()
+                    loss = args.weight_rot * loss_rot_target
                     # Backpropagate
-                    loss.backward()
+                    backward(loss)
 
                     del img_rgb, img_depth, trans_label, loss
 
+                record_train_losses(epoch, batch_num, losses)
                 pb.update(1)
 
     # ========================= VALIDATION =========================
 
-    # Classification - source
-    actual_test_batches = min(len(test_loader_source), args.test_batches or len(test_loader_source))
-    with EvaluationManager(net_list), tqdm(total=actual_test_batches, desc="TestClS") as pb:
-        test_source_loader_iter = iter(test_loader_source)
-        correct = 0.0
-        num_predictions = 0.0
-        val_loss = 0.0
-
-        for num_batch, (img_rgb, img_depth, img_label_source) in enumerate(test_source_loader_iter):
-            # By default validate only on 100 batches
-            if num_batch >= args.test_batches and args.test_batches > 0:
-                break
-
-            # TODO
-            """
-            Here you should move the batch on GPU, compute the features and then the
-            main task prediction
-            """
-            # Compute source features
-            img_rgb, img_depth, img_label_source = map_to_device(device, (img_rgb, img_depth, img_label_source))
-            feat_rgb, _ = netG_rgb(img_rgb)
-            feat_depth, _ = netG_depth(img_depth)
-            features_source = torch.cat((feat_rgb, feat_depth), 1)
+    # Same batch norm statistics on all the ranks
+    average_buffers(net_list)
 
-            # Compute predictions
-            preds = netF(features_source)
+    if args.fused_eval:
+        # Each test set is decoded once for both tasks (see evaluate_fused)
+        (val_acc, val_loss, confusion), (trans_val_acc, val_loss_rot, rot_confusion) = evaluate_fused(
+            fused_test_loader_source, "TestS", warmup=compile_warmup)
+        print("Epoch: {} - Validation source accuracy (recognition): {}".format(epoch, val_acc))
+        (accuracy, _, confusion_target), (trans_val_acc_target, val_loss_rot_target, rot_confusion_target) = \
+            evaluate_fused(fused_test_loader_target, "TestT")
+        if args.weight_rot > 0.0:
+            print("Epoch: {} - Val SRC ROT accuracy (center crop):{}".format(epoch, trans_val_acc))
+            print("Epoch: {} - Val TRG ROT accuracy (center crop):{}".format(epoch, trans_val_acc_target))
+        print("Epoch: {} - Val TRG ROT accuracy:{}".format(epoch, accuracy))
+    else:
+        # Classification - source
+        actual_test_batches = min(len(test_loader_source), args.test_batches or len(test_loader_source))
+        with EvaluationManager(net_list), autocast(), tqdm(total=actual_test_batches, desc="TestClS") as pb:
+            test_source_loader_iter = iter(test_loader_source)
+            # Summed on the device, read once at the end
+            metrics = MetricAccumulator(device)
+
+            for num_batch, (img_rgb, img_depth, img_label_source) in enumerate(test_source_loader_iter):
+                # By default validate only on 100 batches
+                if num_batch >= args.test_batches and args.test_batches > 0:
+                    break
 
-            val_loss += ce_loss(preds, img_label_source).item()
-            correct += (torch.argmax(preds, dim=1) == img_label_source).sum().item()
-            num_predictions += preds.shape[0]
+                # TODO
+                """
+                Here you should move the batch on GPU, compute the features and then the
+                main task prediction
+                """
+                # Compute source features
+                eval_timer.start()
+                img_rgb, img_depth, img_label_source = map_to_device(device, (img_rgb, img_depth, img_label_source))
+                (img_rgb, img_depth), num_samples = pad_batch(img_rgb, img_depth)
+                feat_rgb, _, feat_depth, _ = extract_features(img_rgb, img_depth)
+                features_source = torch.cat((feat_rgb, feat_depth), 1)
 
+                # Compute predictions
+                preds = netF(features_source)[:num_samples]
+                eval_timer.stop(warmup=compile_warmup and num_batch == 0)
 
-            pb.update(1)
+                # Loss weighted by the samples, since the last batch may be smaller
+                pred_labels = torch.argmax(preds, dim=1)
+                metrics.add(loss=ce_loss(preds, img_label_source) * num_samples,
+                            correct=(pred_labels == img_label_source).sum(), samples=num_samples,
+                            confusion=confusion_counts(pred_labels, img_label_source, class_num))
 
-        # TODO: output the accuracy
-        val_acc = correct / num_predictions
-        val_loss = val_loss / args.test_batches
-        print("Epoch: {} - Validation source accuracy (recognition): {}".format(epoch, val_acc))
+                pb.update(1)
 
-    del img_rgb, img_depth, img_label_source
+            # TODO: output the accuracy
+            results = metrics.compute()
+            val_acc = MetricAccumulator.mean(results, 'correct', 'samples')
+            val_loss = MetricAccumulator.mean(results, 'loss', 'samples')
+            confusion = ConfusionMatrix(class_num, results.get('confusion'))
+            print("Epoch: {} - Validation source accuracy (recognition): {}".format(epoch, val_acc))
 
-    # TODO: log accuracy and loss
-    writer.add_scalar("Loss/train", loss_rec.item(), epoch)
-    writer.add_scalar("Loss/val", val_loss, epoch)
-    writer.add_scalar("Accuracy/val", val_acc, epoch)
+        del img_rgb, img_depth, img_label_source
 
-    # Relative Rotation
-    if args.weight_rot > 0.0:
+        # Relative Rotation
+        if args.weight_rot > 0.0:
 
-        # Rotation - source
-        cf_matrix = np.zeros((4, 4))
-        actual_test_batches = min(len(trans_test_source_loader), args.test_batches or len(trans_test_source_loader))
-        with EvaluationManager(net_list), tqdm(total=actual_test_batches, desc="TestRtS") as pb:
-            trans_test_source_loader_iter = iter(trans_test_source_loader)
-            correct = 0.0
-            num_predictions = 0.0
-            val_loss = 0.0
-
-            for num_val_batch, (img_rgb, img_depth, _, trans_label) in enumerate(trans_test_source_loader_iter):
-                if num_val_batch >= args.test_batches and args.test_batches > 0:
-                    break
+            # Rotation - source
+            actual_test_batches = min(len(trans_test_source_loader), args.test_batches or len(trans_test_source_loader))
+            with EvaluationManager(net_list), autocast(), tqdm(total=actual_test_batches, desc="TestRtS") as pb:
+                trans_test_source_loader_iter = iter(trans_test_source_loader)
+                metrics = MetricAccumulator(device)
 
-                # TODO: very similar to the previous part
-                img_rgb, img_depth, trans_label = map_to_device(device, (img_rgb, img_depth, trans_label))
+                for num_val_batch, (img_rgb, img_depth, _, trans_label) in enumerate(trans_test_source_loader_iter):
+                    if num_val_batch >= args.test_batches and args.test_batches > 0:
+                        break
 
-                # Compute features (without pooling)
-                _, pooled_rgb = netG_rgb(img_rgb)
-                _, pooled_depth = netG_depth(img_depth)
-                # Compute predictions
-                preds = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))
+                    # TODO: very similar to the previous part
+                    eval_timer.start()
+                    img_rgb, img_depth, trans_label = map_to_device(device, (img_rgb, img_depth, trans_label))
+                    (img_rgb, img_depth), num_samples = pad_batch(img_rgb, img_depth)
 
-                val_loss_rot = ce_loss(preds, trans_label).item()
-                correct += (torch.argmax(preds, dim=1) == trans_label).sum().item()
-                num_predictions += preds.shape[0]
+                    # Compute features (without pooling)
+                    _, pooled_rgb, _, pooled_depth = extract_features(img_rgb, img_depth)
+                    # Compute predictions
+                    preds = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))[:num_samples]
+                    eval_timer.stop(warmup=compile_warmup and num_val_batch == 0)
 
-                pb.update(1)
+                    pred_labels = torch.argmax(preds, dim=1)
+                    metrics.add(loss=ce_loss(preds, trans_label) * num_samples,
+                                correct=(pred_labels == trans_label).sum(), samples=num_samples,
+                                confusion=confusion_counts(pred_labels, trans_label, class_num_classifier))
 
-            trans_val_acc = correct/num_predictions
-            del img_rgb, img_depth, trans_label
+                    pb.update(1)
 
-            # TODO
-            print("Epoch: {} - Val SRC ROT accuracy:{}".format(epoch, trans_val_acc))
+                results = metrics.compute()
+                trans_val_acc = MetricAccumulator.mean(results, 'correct', 'samples')
+                val_loss_rot = MetricAccumulator.mean(results, 'loss', 'samples')
+                rot_confusion = ConfusionMatrix(class_num_classifier, results.get('confusion'))
+                del img_rgb, img_depth, trans_label
 
-        # Rotation - target
-        actual_test_batches = min(len(trans_test_target_loader), args.test_batches or len(trans_test_target_loader))
-        with EvaluationManager(net_list), tqdm(total=actual_test_batches, desc="TestRtT") as pb:
-            trans_test_target_loader_iter = iter(trans_test_target_loader)
-            correct = 0.0
-            num_predictions = 0.0
-            val_loss = 0.0
+                # TODO
+                print("Epoch: {} - Val SRC ROT accuracy:{}".format(epoch, trans_val_acc))
 
-            for num_val_batch, (img_rgb, img_depth, _, trans_label) in enumerate(trans_test_target_loader_iter):
-                if num_val_batch >= args.test_batches and args.test_batches > 0:
-                    break
+            # Rotation - target
+            actual_test_batches = min(len(trans_test_target_loader), args.test_batches or len(trans_test_target_loader))
+            with EvaluationManager(net_list), autocast(), tqdm(total=actual_test_batches, desc="TestRtT") as pb:
+                trans_test_target_loader_iter = iter(trans_test_target_loader)
+                metrics = MetricAccumulator(device)
 
-                # TODO: very similar to the previous part
-                img_rgb, img_depth, trans_label = map_to_device(device, (img_rgb, img_depth, trans_label))
+                for num_val_batch, (img_rgb, img_depth, _, trans_label) in enumerate(trans_test_target_loader_iter):
+                    if num_val_batch >= args.test_batches and args.test_batches > 0:
+                        break
 
-                # Compute features (without pooling)
-                _, pooled_rgb = netG_rgb(img_rgb)
-                _, pooled_depth = netG_depth(img_depth)
-                # Compute predictions
-                preds = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))
+                    # TODO: very similar to the previous part
+                    eval_timer.start()
+                    img_rgb, img_depth, trans_label = map_to_device(device, (img_rgb, img_depth, trans_label))
+                    (img_rgb, img_depth), num_samples = pad_batch(img_rgb, img_depth)
 
-                val_loss_rot += ce_loss(preds, trans_label).item()
-                correct += (torch.argmax(preds, dim=1) == trans_label).sum().item()
-                num_predictions += preds.shape[0]
+                    # Compute features (without pooling)
+                    _, pooled_rgb, _, pooled_depth = extract_features(img_rgb, img_depth)
+                    # Compute predictions
+                    preds = netF_rot(torch.cat((pooled_rgb, pooled_depth), 1))[:num_samples]
+                    eval_timer.stop()
 
+                    pred_labels = torch.argmax(preds, dim=1)
+                    metrics.add(loss=ce_loss(preds, trans_label) * num_samples,
+                                correct=(pred_labels == trans_label).sum(), samples=num_samples,
+                                confusion=confusion_counts(pred_labels, trans_label, class_num_classifier))
 
+                    pb.update(1)
 
-                pb.update(1)
+                # TODO
+                results = metrics.compute()
+                trans_val_acc_target = MetricAccumulator.mean(results, 'correct', 'samples')
+                val_loss_rot_target = MetricAccumulator.mean(results, 'loss', 'samples')
+                rot_confusion_target = ConfusionMatrix(class_num_classifier, results.get('confusion'))
+                print("Epoch: {} - Val TRG ROT accuracy:{}".format(epoch, trans_val_acc_target))
 
-            # TODO
-            trans_val_acc = correct/num_predictions
-            print("Epoch: {} - Val TRG ROT accuracy:{}".format(epoch, trans_val_acc))
+            del img_rgb, img_depth, trans_label
 
-        del img_rgb, img_depth, trans_label
+        # Classification - target
+        with EvaluationManager(net_list), autocast(), tqdm(total=len(test_loader_target), desc="TestClT") as pb:
+            # Test target
+            metrics = MetricAccumulator(device)
 
-        # TODO
-        writer.add_scalar("Loss/rot", loss_rot, epoch)
-        writer.add_scalar("Loss/rot_val", val_loss_rot, epoch)
-        writer.add_scalar("Accuracy/rot_val", trans_val_acc, epoch)
+            for num_batch, (img_rgb, img_depth, img_label_source) in enumerate(test_loader_target):
+                if num_batch >= args.test_batches and args.test_batches > 0:
+                    break
+                # Move tensors to GPU
+                eval_timer.start()
+                img_rgb, img_depth, img_label_source = map_to_device(device, (img_rgb, img_depth, img_label_source))
+                (img_rgb, img_depth), num_samples = pad_batch(img_rgb, img_depth)
+                # Compute features
+                feat_rgb, _, feat_depth, _ = extract_features(img_rgb, img_depth)
+                # Compute predictions
+                pred = netF(torch.cat((feat_rgb, feat_depth), 1))[:num_samples]
+                eval_timer.stop()
+                pred = F.softmax(pred, dim=1)
+                pred_labels = torch.argmax(pred, dim=1)
+                metrics.add(correct=(pred_labels == img_label_source).sum(), samples=num_samples,
+                            confusion=confusion_counts(pred_labels, img_label_source, class_num))
 
-    # Classification - target
-    with EvaluationManager(net_list), tqdm(total=len(test_loader_target), desc="TestClT") as pb:
-        # Test target
-        correct = 0.0
-        num_predictions = 0.0
-        val_loss_class_target = 0.0
+                pb.update(1)
 
-        for num_batch, (img_rgb, img_depth, img_label_source) in enumerate(test_loader_target):
-            if num_batch >= args.test_batches and args.test_batches > 0:
-                break
-            # Move tensors to GPU
-            img_rgb, img_depth, img_label_source = map_to_device(device, (img_rgb, img_depth, img_label_source))
-            # Compute features
-            feat_rgb, _ = netG_rgb(img_rgb)
-            feat_depth, _ = netG_depth(img_depth)
-            # Compute predictions
-            pred = netF(torch.cat((feat_rgb, feat_depth), 1))
-            pred = F.softmax(pred, dim=1)
-            correct += (torch.argmax(pred, dim=1) == img_label_source).sum().item()
-            num_predictions += img_label_source.shape[0]
+            # TODO: Output accuracy
+            results = metrics.compute()
+            accuracy = MetricAccumulator.mean(results, 'correct', 'samples')
+            confusion_target = ConfusionMatrix(class_num, results.get('confusion'))
 
-            pb.update(1)
+            print("Epoch: {} - Val TRG ROT accuracy:{}".format(epoch, accuracy))
 
-        # TODO: Output accuracy
-        accuracy = correct / num_predictions
+        del img_rgb, img_depth, img_label_source
 
-        print("Epoch: {} - Val TRG ROT accuracy:{}".format(epoch, accuracy))
+    # TODO: log accuracy and loss
+    # Mean training losses of the epoch
+    train_results = train_metrics.compute()
+    for name, tag in TRAIN_LOSS_TAGS.items():
+        if name in train_results:
+            writer.add_scalar(tag, MetricAccumulator.mean(train_results, name, 'batches'), epoch)
+    writer.add_scalar("Loss/val", val_loss, epoch)
+    writer.add_scalar("Accuracy/val", val_acc, epoch)
+    # Balanced accuracy, per-class accuracy and top confusions
+    confusion.log(writer, "Accuracy/val", epoch)
 
-    del img_rgb, img_depth, img_label_source
+    if args.weight_rot > 0.0:
+        # The fused evaluation measures the rotation task on other views (center crop, no horizontal flip)
+        rot_val = "rot_val_center" if args.fused_eval else "rot_val"
+        writer.add_scalar("Loss/" + rot_val, val_loss_rot, epoch)
+        writer.add_scalar("Accuracy/" + rot_val, trans_val_acc, epoch)
+        writer.add_scalar("Loss/{}_target".format(rot_val), val_loss_rot_target, epoch)
+        writer.add_scalar("Accuracy/{}_target".format(rot_val), trans_val_acc_target, epoch)
+        rot_confusion.log(writer, "Accuracy/" + rot_val, epoch)
+        rot_confusion_target.log(writer, "Accuracy/{}_target".format(rot_val), epoch)
 
     # TODO: log loss and accuracy
 
     #writer.add_scalar("Loss/train_target", loss_rot, epoch)
     #writer.add_scalar("Loss/val_target", val_loss_class_target, epoch)
     writer.add_scalar("Accuracy/val_target", accuracy, epoch)
+    confusion_target.log(writer, "Accuracy/val_target", epoch)
+
+    if image_cache is not None:
+        hits, misses = image_cache.stats()
+        hit_rate = hits / max(hits + misses, 1)
+        print("Epoch: {} - Image cache hit rate: {:.3f} ({} hits, {} misses)".format(epoch, hit_rate, hits, misses))
+        writer.add_scalar("Cache/hit_rate", hit_rate, epoch)
+
+    # Steady-state step times, to compare runs with and without --compile, and compilation time
+    print("Epoch: {} - Step time: train {:.3f}s, eval {:.3f}s".format(epoch, train_timer.steady, eval_timer.steady))
+    # Learning rate of the backbones (the heads' being lr_mult times it) for the next epoch
+    writer.add_scalar("LR/backbone", optimizer.param_groups[0]['lr'], epoch)
+    writer.add_scalar("Time/train_step", train_timer.steady, epoch)
+    writer.add_scalar("Time/eval_step", eval_timer.steady, epoch)
+    writer.add_scalar("Time/train_epoch", train_timer.steady * num_micro_batches, epoch)
+    if compile_warmup:
+        print("Compilation: train {:.1f}s, eval {:.1f}s".format(train_timer.warmup_time, eval_timer.warmup_time))
+        writer.add_scalar("Time/compile_train", train_timer.warmup_time, epoch)
+        writer.add_scalar("Time/compile_eval", eval_timer.warmup_time, epoch)
 
     # Save checkpoint
-    save_checkpoint(checkpoint_path, epoch, net_list, optims_list)
-    print("Checkpoint saved")
+    if rank == 0:
+        save_checkpoint(checkpoint_path, epoch, net_list, optims_list, scaler=scaler, scheduler=scheduler)
+        print("Checkpoint saved")
+
+if distributed:
+    dist.destroy_process_group()
@@ -1,14 +1,22 @@
 import argparse
+import contextlib
 import functools
 import os.path
+import queue
+import threading
 import time
 from datetime import datetime
-from typing import Sequence, Text, Union
+from typing import Sequence, Text, Tuple, Union
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as opt
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset, Sampler
+
+from net import SplitBatchNorm, RESNET_LAYERS
 
 
 def weights_init(m):
@@ -35,24 +43,150 @@ def entropy_loss(logits):
     :param logits:
     :return:
     """
-    p_softmax = F.softmax(logits, dim=1)
+    # Computed in float32 also under autocast, the log of small probabilities is too coarse in half precision
+    p_softmax = F.softmax(logits.float(), dim=1)
     mask = p_softmax.ge(0.000001)  # greater or equal to
     mask_out = torch.masked_select(p_softmax, mask)
     entropy = -(torch.sum(mask_out * torch.log(mask_out)))
     return entropy / float(p_softmax.size(0))
 
 
+def make_optimizer(groups: Sequence[Tuple[nn.Module, float]], momentum: float = 0.9, weight_decay: float = 0.0):
+    """
+    Build a single SGD optimizer for several modules, with a parameter group per module, so that each step updates all
+    the parameters with the fused (or multi-tensor) kernels instead of a Python loop over optimizers and tensors
+    :param groups:
+        (module, learning rate) for each parameter group, in the order of the groups
+    :param momentum:
+        Momentum factor
+    :param weight_decay:
+        Weight decay regularization
+    :return:
+        The optimizer
+    """
+    param_groups = [{'params': list(module.parameters()), 'lr': lr} for module, lr in groups]
+    try:
+        return opt.SGD(param_groups, lr=groups[0][1], momentum=momentum, weight_decay=weight_decay, fused=True)
+    except RuntimeError:
+        # No fused kernel for the device of the parameters
+        return opt.SGD(param_groups, lr=groups[0][1], momentum=momentum, weight_decay=weight_decay, foreach=True)
+
+
+def make_scheduler(optimizer: opt.Optimizer, schedule: Text, epochs: int, steps_per_epoch: int,
+                   warmup_epochs: float = 0.0, step_epochs: int = 10, gamma: float = 0.1):
+    """
+    Build a learning rate scheduler stepped after every optimizer step. The learning rates of the parameter groups of
+    optimizer are the peak ones
+    :param optimizer:
+        Optimizer whose learning rates are scheduled
+    :param schedule:
+        constant, cosine (annealing to 0 at the end of the training), step (multiplied by gamma every step_epochs) or
+        onecycle (linear increase and cosine annealing, see torch.optim.lr_scheduler.OneCycleLR)
+    :param epochs:
+        Epochs of the training
+    :param steps_per_epoch:
+        Optimizer steps per epoch
+    :param warmup_epochs:
+        Epochs of linear increase of the learning rates before the schedule, which starts when they reach their peak.
+        For onecycle, the part of the cycle in which they increase instead (0.3 of the training if 0)
+    :param step_epochs:
+        Period of the step schedule
+    :param gamma:
+        Factor of the step schedule
+    :return:
+        The scheduler, None for a constant learning rate without warm-up. Its schedule attribute holds the parameters
+        defining the schedule, which a checkpoint must match to be resumed with it (see load_checkpoint)
+    """
+    sched = opt.lr_scheduler
+    total_steps = epochs * steps_per_epoch
+    warmup_steps = min(int(warmup_epochs * steps_per_epoch), total_steps - 1)
+    params = {'schedule': schedule, 'steps_per_epoch': steps_per_epoch, 'warmup_steps': warmup_steps}
+    if schedule == 'onecycle':
+        scheduler = sched.OneCycleLR(optimizer, max_lr=[group['lr'] for group in optimizer.param_groups],
+                                     total_steps=total_steps,
+                                     pct_start=warmup_steps / total_steps if warmup_steps else 0.3)
+        scheduler.schedule = dict(params, total_steps=total_steps)
+        return scheduler
+    if schedule == 'constant':
+        if warmup_steps == 0:
+            return None
+        scheduler = sched.ConstantLR(optimizer, factor=1.0, total_iters=0)
+    elif schedule == 'cosine':
+        scheduler = sched.CosineAnnealingLR(optimizer, T_max=total_steps - warmup_steps)
+        params['total_steps'] = total_steps
+    elif schedule == 'step':
+        scheduler = sched.StepLR(optimizer, step_size=step_epochs * steps_per_epoch, gamma=gamma)
+        params.update(step_epochs=step_epochs, gamma=gamma)
+    else:
+        raise ValueError("Unknown learning rate schedule {}".format(schedule))
+    if warmup_steps > 0:
+        warmup = sched.LinearLR(optimizer, start_factor=1.0 / warmup_steps, total_iters=warmup_steps)
+        scheduler = sched.SequentialLR(optimizer, [warmup, scheduler], milestones=[warmup_steps])
+    scheduler.schedule = params
+    return scheduler
+
+
+def merge_optimizer_states(states: Sequence[dict], optimizer: opt.Optimizer) -> dict:
+    """
+    Merge the state dicts of several optimizers into the state dict of a single optimizer whose parameter groups are
+    the groups of those optimizers in the same order, e.g. to resume with make_optimizer from a checkpoint saved with an
+    optimizer per module. The choice of the kernels (foreach, fused) is kept from optimizer
+    :param states:
+        State dicts of the optimizers
+    :param optimizer:
+        Optimizer which will load the merged state dict
+    :return:
+        Merged state dict
+    """
+    state, param_groups = {}, []
+    offset = 0
+    for state_dict in states:
+        # Parameters are numbered consecutively across the groups of each state dict: renumber them after the ones of
+        # the previous state dicts
+        ids = {}
+        for group in state_dict['param_groups']:
+            group = dict(group)
+            group['params'] = [ids.setdefault(i, offset + len(ids)) for i in group['params']]
+            param_groups.append(group)
+        state.update({ids[i]: s for i, s in state_dict['state'].items()})
+        offset += len(ids)
+    for group, current in zip(param_groups, optimizer.param_groups):
+        for key in ('foreach', 'fused'):
+            if key in current:
+                group[key] = current[key]
+    return {'state': state, 'param_groups': param_groups}
+
+
 class OptimizerManager:
-    def __init__(self, optims):
+    """
+    Zero the gradients before a training step and perform the optimization step after it. With gradient accumulation
+    a step spans several micro-batches: the gradients are zeroed before the first one only (zero_grad) and the
+    optimizers step after the last one only (step). The learning rate schedulers step after the optimizers
+    """
+    def __init__(self, optims, scaler=None, zero_grad=True, step=True, schedulers=()):
         self.optims = optims
+        # Optional torch.amp.GradScaler which scaled the losses
+        self.scaler = scaler
+        self.zero_grad = zero_grad
+        self.step = step
+        self.schedulers = schedulers
 
     def __enter__(self):
-        for op in self.optims:
-            op.zero_grad()
+        if self.zero_grad:
+            for op in self.optims:
+                op.zero_grad(set_to_none=True)
 
     def __exit__(self, exceptionType, exception, exceptionTraceback):
-        for op in self.optims:
-            op.step()
+        if self.step and self.scaler is not None:
+            for op in self.optims:
+                self.scaler.step(op)
+            self.scaler.update()
+        elif self.step:
+            for op in self.optims:
+                op.step()
+        if self.step:
+            for scheduler in self.schedulers:
+                scheduler.step()
         self.optims = None
         if exceptionTraceback:
             print(exceptionTraceback)
@@ -85,23 +219,323 @@ class EvaluationManager:
         return decorate_no_grad
 
 
+class StepTimer:
+    """
+    Wall time of the steps of a loop, excluding the time spent waiting for the data. Warm-up steps (e.g. those
+    compiling with torch.compile) are kept out of the steady-state mean, and their excess over it is reported separately.
+    On CUDA the steps are delimited by events recorded on the stream of the device, so timing them doesn't make the host
+    wait for the device: the times are read, with a single synchronization, when steady or warmup_time are accessed
+    (e.g. once at the end of the epoch)
+    """
+    def __init__(self, device):
+        self.device = device
+        self.times = []
+        self.warmup_times = []
+        self.start_time = None
+        # (start event, end event, warmup) of the CUDA steps whose times haven't been read yet
+        self.pending = []
+
+    def start(self):
+        if self.device.type == 'cuda':
+            self.start_time = torch.cuda.Event(enable_timing=True)
+            self.start_time.record(torch.cuda.current_stream(self.device))
+        else:
+            self.start_time = time.perf_counter()
+
+    def stop(self, warmup=False):
+        if self.device.type == 'cuda':
+            end = torch.cuda.Event(enable_timing=True)
+            end.record(torch.cuda.current_stream(self.device))
+            self.pending.append((self.start_time, end, warmup))
+        else:
+            (self.warmup_times if warmup else self.times).append(time.perf_counter() - self.start_time)
+
+    def collect(self):
+        """
+        Read the times of the CUDA steps recorded so far
+        """
+        if not self.pending:
+            return
+        # Events complete in order on the stream
+        self.pending[-1][1].synchronize()
+        for start, end, warmup in self.pending:
+            (self.warmup_times if warmup else self.times).append(start.elapsed_time(end) / 1000)
+        self.pending = []
+
+    @contextlib.contextmanager
+    def step(self, warmup=False):
+        self.start()
+        yield
+        self.stop(warmup)
+
+    @property
+    def steady(self):
+        """
+        Mean time of a step after the warm-up (nan if there are no such steps)
+        """
+        self.collect()
+        return sum(self.times) / len(self.times) if self.times else float('nan')
+
+    @property
+    def warmup_time(self):
+        """
+        Time of the warm-up steps in excess of the steady-state time of a step
+        """
+        self.collect()
+        steady = self.steady if self.times else 0.
+        return sum(self.warmup_times) - len(self.warmup_times) * steady
+
+
+class BatchNormSplitManager:
+    """
+    Make the net.SplitBatchNorm layers of some networks normalize consecutive chunks of the batch (e.g. the sub-batches
+    of the two domains) with separate statistics
+    """
+    def __init__(self, nets, sizes):
+        self.nets = nets
+        self.sizes = sizes
+
+    def __enter__(self):
+        for net in self.nets:
+            for module in net.modules():
+                if isinstance(module, SplitBatchNorm):
+                    module.split_sizes = self.sizes
+
+    def __exit__(self, *args):
+        for net in self.nets:
+            for module in net.modules():
+                if isinstance(module, SplitBatchNorm):
+                    module.split_sizes = None
+        return False
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def init_distributed(backend='gloo'):
+    """
+    Join the process group of a run launched with torchrun (or any launcher setting RANK, WORLD_SIZE, MASTER_ADDR and
+    MASTER_PORT), if it has more than one process
+    :param backend:
+        gloo (CPU or CUDA tensors) or nccl (CUDA only)
+    :return:
+        rank, world size, local rank (index of the process on its node)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, 0
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        # One GPU per process: the current device is the one nccl (and any other CUDA call without a device) uses
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend)
+    return dist.get_rank(), world_size, local_rank
+
+
+def sampler_args(dataset, shuffle):
+    """
+    Sampling arguments of a DataLoader over dataset: in distributed training a DistributedSampler, so that every rank
+    loads its share of the dataset, otherwise the shuffle of the DataLoader. IterableDatasets shard themselves (see
+    TarShardDataset)
+    """
+    if not is_distributed() or isinstance(dataset, IterableDataset):
+        return {'shuffle': shuffle}
+    return {'shuffle': False, 'sampler': DistributedSampler(dataset, shuffle=shuffle)}
+
+
+@contextlib.contextmanager
+def no_sync(modules, enabled=True):
+    """
+    Skip the gradient all-reduce of the DistributedDataParallel modules for the backward passes of the forward passes
+    run in the context, e.g. for all the micro-batches of an optimizer step but the last one. The gradients accumulate
+    locally and are all-reduced in the first backward pass outside of it
+    """
+    with contextlib.ExitStack() as stack:
+        if enabled:
+            for module in modules:
+                if isinstance(module, DistributedDataParallel):
+                    stack.enter_context(module.no_sync())
+        yield
+
+
+def average_buffers(modules):
+    """
+    Average the floating point buffers (batch norm running statistics) of modules over the ranks, which update them
+    with their own batches, so that all the ranks evaluate and save the same model
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for module in modules:
+            for buffer in module.buffers():
+                if buffer.is_floating_point():
+                    dist.all_reduce(buffer)
+                    buffer /= dist.get_world_size()
+
+
+class NullWriter:
+    """
+    Stand-in for SummaryWriter on the ranks which don't log
+    """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+# Sampler epochs of the auxiliary loaders in training epoch e start at e << SAMPLER_EPOCH_SHIFT (see IteratorWrapper)
+SAMPLER_EPOCH_SHIFT = 16
+
+
 class IteratorWrapper:
-    def __init__(self, loader):
+    """
+    Endless access to a loader, restarted whenever it runs out. A distributed sampler gives the same permutation until
+    its epoch changes, so its epoch is moved forward at every start: to epoch << SAMPLER_EPOCH_SHIFT for the wrapper of
+    a training epoch, and by one at every restart within it, always increasing so that no permutation is replayed
+    """
+    def __init__(self, loader, epoch=0):
         self.loader = loader
+        self.advance(epoch)
         self.iterator = iter(loader)
 
+    def advance(self, epoch=0):
+        sampler = getattr(self.loader, 'sampler', None)
+        if isinstance(sampler, DistributedSampler):
+            sampler.set_epoch(max(sampler.epoch + 1, epoch << SAMPLER_EPOCH_SHIFT))
+
     def __iter__(self):
+        self.advance()
         self.iterator = iter(self.loader)
 
     def get_next(self):
         try:
-            items = self.iterator.next()
-        except:
+            items = next(self.iterator)
+        except StopIteration:
             self.__iter__()
-            items = self.iterator.next()
+            items = next(self.iterator)
         return items
 
 
+class InfiniteSampler(Sampler):
+    """
+    Endless sequence of indices: a new random permutation of the dataset every time the previous one is exhausted.
+    A DataLoader using it never ends, hence never restarts its workers.
+    In distributed training every rank takes its share of each permutation, as with DistributedSampler, so the ranks
+    must agree on the seed (0 by default, as DistributedSampler)
+    """
+    def __init__(self, size, shuffle=True, seed=None):
+        self.size = size
+        self.shuffle = shuffle
+        self.rank, self.num_replicas = (dist.get_rank(), dist.get_world_size()) if is_distributed() else (0, 1)
+        if seed is None:
+            seed = 0 if self.num_replicas > 1 else int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        while True:
+            if self.shuffle:
+                indices = torch.randperm(self.size, generator=generator).tolist()
+            else:
+                indices = range(self.size)
+            yield from indices[self.rank::self.num_replicas]
+
+
+class PrefetchStream:
+    """
+    Endless stream of batches from a loader built on an InfiniteSampler. A background thread keeps up to prefetch
+    batches ready. It can be used in place of IteratorWrapper (get_next) or iterated over
+    """
+    def __init__(self, loader, prefetch=2):
+        self.loader = loader
+        self.queue = queue.Queue(maxsize=prefetch)
+        # Fork the workers from the main thread: forking from a background thread while the main one is computing
+        # can leave the process deadlocked
+        self.iterator = iter(loader)
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            for batch in self.iterator:
+                self.queue.put((batch, None))
+            raise RuntimeError("PrefetchStream needs an endless loader, see InfiniteSampler")
+        except Exception as e:
+            self.queue.put((None, e))
+
+    def get_next(self):
+        batch, error = self.queue.get()
+        if error is not None:
+            raise error
+        return batch
+
+    def __iter__(self):
+        while True:
+            yield self.get_next()
+
+
+def make_stream(dataset, batch_size, num_workers, prefetch=2):
+    """
+    Build a PrefetchStream over a dataset, with persistent workers which are started only once. An IterableDataset
+    must never end by itself (see TarShardDataset(repeat=True))
+    """
+    loader = DataLoader(dataset,
+                        sampler=None if isinstance(dataset, IterableDataset) else InfiniteSampler(len(dataset)),
+                        batch_size=batch_size,
+                        num_workers=num_workers,
+                        persistent_workers=num_workers > 0,
+                        drop_last=True)
+    return PrefetchStream(loader, prefetch)
+
+
+class MultiViewIterator:
+    """
+    Split the batches of a multi-view loader (see DatasetGeneratorMultimodal(multi_view=True)) into the plain view
+    (img_rgb, img_depth, label) and the rotated view (img_rgb, img_depth, label, trans_label). Iterating over it
+    yields the plain views of one epoch, while stream() gives IteratorWrapper-like access to either view.
+    A view which has already been consumed triggers a new draw.
+    """
+    def __init__(self, loader, epoch=0):
+        self.loader = loader
+        # Training epoch of the IteratorWrapper of the streams
+        self.epoch = epoch
+        # Created only if needed, so that no extra workers are started when just iterating
+        self.iterator = None
+        self.views = {}
+
+    def __iter__(self):
+        for batch in self.loader:
+            self.views = self.split(batch)
+            yield self.views.pop('plain')
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def split(batch):
+        img_rgb, img_depth, label, rot_rgb, rot_depth, trans_label = batch
+        return {'plain': (img_rgb, img_depth, label), 'rotated': (rot_rgb, rot_depth, label, trans_label)}
+
+    def get_view(self, name):
+        if name not in self.views:
+            if self.iterator is None:
+                self.iterator = IteratorWrapper(self.loader, self.epoch)
+            self.views = self.split(self.iterator.get_next())
+        return self.views.pop(name)
+
+    def stream(self, name):
+        return ViewStream(self, name)
+
+
+class ViewStream:
+    def __init__(self, multi_view, name):
+        self.multi_view = multi_view
+        self.name = name
+
+    def get_next(self):
+        return self.multi_view.get_view(self.name)
+
+
 def add_base_args(parser: argparse.ArgumentParser):
     """
     Add arguments which are not specific for the DA method. If you implement several versions of train.py you can
@@ -111,23 +545,97 @@ def add_base_args(parser: argparse.ArgumentParser):
     """
     # Dataset arguments
     parser.add_argument("--data_root")
+    parser.add_argument("--packed", action='store_true',
+                        help="Read the images from the memory-mapped shards written by pack_dataset.py")
+    parser.add_argument("--tar_shards", action='store_true',
+                        help="Stream the training sets from the tar shards written by make_shards.py")
+    parser.add_argument("--shuffle_buffer", default=1000, type=int,
+                        help="Samples in the shuffle buffer of each worker reading the tar shards")
+    parser.add_argument("--batch_aug", action='store_true',
+                        help="Crop, flip, rotate and normalize whole batches on the device instead of in the workers")
+    parser.add_argument("--multi_view", action='store_true',
+                        help="Decode each training pair once for both the recognition and the rotation views")
+    parser.add_argument("--cache_mb", default=0, type=int,
+                        help="Size in MB of the decoded image cache shared by all the workers (0 to disable)")
+    parser.add_argument("--fast_decode", action='store_true',
+                        help="Decode JPEG images at reduced size (close to, not exactly, the default pixels)")
+    parser.add_argument("--io_threads", default=0, type=int,
+                        help="Threads reading the image files in each worker, to overlap RGB, depth and the samples of "
+                             "a batch (0 to read them one after the other)")
+    parser.add_argument("--uint8", action='store_true',
+                        help="Transfer uint8 images from the workers and normalize them on the device")
+    parser.add_argument("--prefetch", default=0, type=int,
+                        help="Turn the auxiliary training loaders into endless streams prefetching this many batches "
+                             "in background (0 to restart them whenever they run out)")
 
     parser.add_argument("--num_workers", default=4, type=int, help="Number of workers for each DataLoader")
     parser.add_argument("--logdir", default="experiments", help="Directory for checkpoints and TensorBoard logs")
     parser.add_argument('--gpu', default=0, help="Which CUDA device to use")
+    parser.add_argument('--dist_backend', default='gloo', choices=['gloo', 'nccl'],
+                        help="Backend of distributed data-parallel training, which is enabled by launching the script "
+                             "with torchrun --nproc_per_node N. batch_size is per process. Each process gets "
+                             "OMP_NUM_THREADS threads (1 by default with torchrun), e.g. cores / N on a CPU box")
     parser.add_argument('--suffix', type=str, default=None, help="Suffix for your run name")
 
     # hyper-params
     parser.add_argument("--epochs", default=40, type=int, help="Number of epochs")
     parser.add_argument("--lr", default=0.0001, type=float, help="Learning rate")
     parser.add_argument("--lr_mult", default=1.0, type=float, help="Learning rate multiplier for non-pretrained layers")
+    parser.add_argument("--lr_schedule", default='constant', choices=['constant', 'cosine', 'step', 'onecycle'],
+                        help="Learning rate schedule, stepped at every optimizer step (see make_scheduler). lr is the "
+                             "peak learning rate. onecycle also cycles the momentum between 0.85 and 0.95")
+    parser.add_argument("--warmup_epochs", default=0.0, type=float,
+                        help="Epochs (possibly fractional) of linear learning rate warm-up before the schedule")
+    parser.add_argument("--lr_step_epochs", default=10, type=int, help="Period of the step schedule in epochs")
+    parser.add_argument("--lr_gamma", default=0.1, type=float, help="Learning rate factor of the step schedule")
     parser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    parser.add_argument("--accum_steps", default=1, type=int,
+                        help="Micro-batches accumulated into each optimizer step, batch_size being the total. Batch "
+                             "norm still normalizes each micro-batch on its own (and updates its running statistics "
+                             "once per micro-batch), so results match batch_size only up to the batch statistics")
     parser.add_argument("--weight_decay", default=0.05, type=float, help="Weight decay regularization")
     parser.add_argument("--dropout_p", default=0.5, help="Dropout (not for the backbone!)")
-
+    parser.add_argument("--precision", default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help="Autocast precision of training and evaluation (fp16 uses a gradient scaler)")
+    parser.add_argument("--joint_step", action='store_true',
+                        help="Forward all the sub-batches of a step (recognition, entropy, rotation) through the "
+                             "networks at once and backpropagate their total loss with a single backward")
+    parser.add_argument("--bn_mode", default='batch', choices=['batch', 'domain', 'joint'],
+                        help="Batch norm statistics in a joint step: per sub-batch (as the separate passes), per "
+                             "domain, or over the whole concatenated batch")
+    parser.add_argument("--compile", action='store_true',
+                        help="Compile the backbones and the heads with torch.compile")
+    parser.add_argument("--compile_mode", default='default',
+                        choices=['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs'],
+                        help="torch.compile mode")
+    parser.add_argument("--channels_last", action='store_true',
+                        help="Run the convolutional networks and the image batches in the channels-last (NHWC) layout")
+    parser.add_argument("--checkpoint_layers", default=[], nargs='*', choices=RESNET_LAYERS,
+                        help="Backbone layers whose activations are recomputed in the backward pass instead of being "
+                             "stored (activation checkpointing): less memory for a larger batch, at the cost of "
+                             "about one more forward pass of those layers per step")
+
+    parser.add_argument("--log_interval", default=0, type=int,
+                        help="Optimizer steps between logs of the mean training losses (Loss/train_step), 0 to log "
+                             "them only once per epoch. Each log waits for the device")
     parser.add_argument('--test_batches', default=585, type=int,
                         help="Number of batches to be considered at test time for source classification and the"
                              " rotation task. Note that the evaluation on target is always done on all batches")
+    parser.add_argument('--fused_eval', action='store_true',
+                        help="Decode every test sample once and evaluate recognition and relative rotation on it with "
+                             "a single backbone pass (see evaluate_fused in train.py). The rotation task is then "
+                             "evaluated on the center crop without horizontal flip instead of a random crop and flip, "
+                             "so its metrics are logged as rot_val_center instead of rot_val")
+    parser.add_argument('--eval_cache', action='store_true',
+                        help="Evaluate the recognition task on fixed subsets of the test sets, decoded only once")
+    parser.add_argument('--eval_cache_dir', default=None,
+                        help="Directory of the cached test subsets, shared by all the nodes in distributed training "
+                             "(default eval_cache in logdir)")
+    parser.add_argument('--eval_samples', default=None, type=int,
+                        help="Size of the cached test subsets (default test_batches * batch_size, 0 for all)")
+    parser.add_argument('--eval_seed', default=0, type=int, help="Seed for choosing the cached test subsets")
+    parser.add_argument('--eval_stratified', action='store_true',
+                        help="Keep the class proportions in the cached test subsets")
     parser.add_argument('--resume', action='store_true', help="Resume from checkpoint if it exists")
 
 
@@ -159,11 +667,11 @@ def save_checkpoint(path: Text,
                     epoch: int,
                     modules: Union[nn.Module, Sequence[nn.Module]],
                     optimizers: Union[opt.Optimizer, Sequence[opt.Optimizer]],
-                    safe_replacement: bool = True):
+                    safe_replacement: bool = True,
+                    scaler: torch.amp.GradScaler = None,
+                    scheduler: opt.lr_scheduler.LRScheduler = None):
     """
     Save a checkpoint of the current state of the training, so it can be resumed.
-    This checkpointing function assumes that there are no learning rate schedulers or gradient scalers for automatic
-    mixed precision.
     :param path:
         Path for your checkpoint file
     :param epoch:
@@ -174,6 +682,10 @@ def save_checkpoint(path: Text,
         Optimizer or list of optimizers
     :param safe_replacement:
         Keep old checkpoint until the new one has been completed
+    :param scaler:
+        Gradient scaler for automatic mixed precision, if any
+    :param scheduler:
+        Learning rate scheduler, if any
     :return:
     """
 
@@ -196,6 +708,11 @@ def save_checkpoint(path: Text,
         # State dict for all the optimizers
         'optimizers': [o.state_dict() for o in optimizers]
     }
+    if scaler is not None:
+        data['scaler'] = scaler.state_dict()
+    if scheduler is not None:
+        data['scheduler'] = scheduler.state_dict()
+        data['schedule'] = getattr(scheduler, 'schedule', None)
 
     # Safe replacement of old checkpoint
     temp_file = None
@@ -220,7 +737,9 @@ def load_checkpoint(path: Text,
                     default_epoch: int,
                     modules: Union[nn.Module, Sequence[nn.Module]],
                     optimizers: Union[opt.Optimizer, Sequence[opt.Optimizer]],
-                    verbose: bool = True):
+                    verbose: bool = True,
+                    scaler: torch.amp.GradScaler = None,
+                    scheduler: opt.lr_scheduler.LRScheduler = None):
     """
     Try to load a checkpoint to resume the training.
     :param path:
@@ -233,6 +752,12 @@ def load_checkpoint(path: Text,
         Optimizer or list of optimizers
     :param verbose:
         Verbose mode
+    :param scaler:
+        Gradient scaler for automatic mixed precision, if any. Left as it is if the checkpoint has no scaler state
+    :param scheduler:
+        Learning rate scheduler, if any. The checkpoint must have scheduler state if and only if there is one (the
+        learning rates saved with the optimizers belong to its schedule), and if both were built by make_scheduler
+        their schedules must have the same parameters (e.g. the same number of epochs)
     :return:
         Next epoch
     """
@@ -246,6 +771,17 @@ def load_checkpoint(path: Text,
         # Load data
         data = torch.load(path, map_location=next(modules[0].parameters()).device)
 
+        # The saved learning rates are those of the saved schedule: loaded with another one (or none) they would be
+        # scheduled again (e.g. warmed up from the peak) or stay decayed, and the saved steps could exceed the schedule
+        if (scheduler is not None) != ('scheduler' in data):
+            raise ValueError(f"Checkpoint {path} was saved {'with' if 'scheduler' in data else 'without'} a learning "
+                             f"rate schedule, it can't be resumed {'with' if scheduler is not None else 'without'} "
+                             f"one: use the same schedule options (--lr_schedule, --warmup_epochs)")
+        saved, current = data.get('schedule'), getattr(scheduler, 'schedule', None)
+        if saved is not None and current is not None and saved != current:
+            raise ValueError(f"Checkpoint {path} was saved with the learning rate schedule {saved}, it can't be "
+                             f"resumed with {current}: use the same schedule options, epochs and batch size")
+
         # Inform the user that we are loading the checkpoint
         if verbose:
             print(f"Loaded checkpoint saved at {datetime.fromtimestamp(data['time']).strftime('%Y-%m-%d %H:%M:%S')}. "
@@ -256,8 +792,19 @@ def load_checkpoint(path: Text,
             modules[i].load_state_dict(data['modules'][i])
 
         # Load state for all the optimizers
-        for i, o in enumerate(optimizers):
-            optimizers[i].load_state_dict(data['optimizers'][i])
+        if len(optimizers) == 1 and len(data['optimizers']) > 1:
+            # Checkpoint with an optimizer per module, resumed with a single optimizer with a group per module
+            if verbose:
+                print(f"Merging the state of {len(data['optimizers'])} optimizers into one")
+            optimizers[0].load_state_dict(merge_optimizer_states(data['optimizers'], optimizers[0]))
+        else:
+            for i, o in enumerate(optimizers):
+                optimizers[i].load_state_dict(data['optimizers'][i])
+
+        if scaler is not None and 'scaler' in data:
+            scaler.load_state_dict(data['scaler'])
+        if scheduler is not None:
+            scheduler.load_state_dict(data['scheduler'])
 
         # Next epoch
         return data['epoch'] + 1